@@ -1,10 +1,38 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
+import os
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import zipfile
+import io
+from plotly.offline import get_plotlyjs
 import warnings
+from tms_analytics import (
+ COUNTRY_REGIONS, lane_drilldown,
+ lane_network_metrics, find_consolidation_candidates,
+ REPORTING_CURRENCY, CURRENCY_LABEL, CURRENCY_SYMBOL, reporting_amount,
+ FINANCIAL_DIMENSIONS, rollup_financials,
+ explorer_positions, search_orders,
+ pivot_dimensions, pivot_measures, new_pivot_cache, pivot_aggregate, pivot_table,
+ SQL_CONSOLE_AVAILABLE, query_tables, run_sql_query,
+ snapshot_aggregates, compare_snapshots,
+ TREND_BREAKDOWNS, ROLLING_WINDOWS, daily_matrix, refresh_trend_state, trend_frame,
+ sla_lateness, demand_forecast,
+ DEFAULT_SCENARIO, build_lane_profiles, run_simulation, summarize_simulation,
+ whatif_financials, build_report_html,
+ save_dataset, load_dataset, dataset_key, batch_units, render_unit_report,
+ ingest_workbook, dataset_job, new_compute_pool, submit_job, wait_for_job, run_jobs, new_folder_watcher,
+ csv_export, excel_export,
+ build_kpi_payload, new_kpi_store, publish_kpis, has_kpis, start_kpi_server,
+ inc_metric, observe_metric, timed_metric
+)
 warnings.filterwarnings('ignore')
 
 # Configure Streamlit page
@@ -15,6 +43,10 @@ layout="wide",
 initial_sidebar_state="expanded"
 )
 
+# Every widget interaction reruns this script - count runs and time them for the metrics endpoint
+script_start = time.perf_counter()
+inc_metric('tms_script_runs_total')
+
 # Custom CSS - minimal styling
 st.markdown("""
 <style>
@@ -73,6 +105,47 @@ help="Upload your 'report raw data.xls' file"
 SERVICE_TYPES = ['CTX', 'CX', 'EF', 'EGD', 'FF', 'RGD', 'ROU', 'SF']
 COUNTRIES = ['AT', 'AU', 'BE', 'DE', 'DK', 'ES', 'FR', 'GB', 'IT', 'N1', 'NL', 'NZ', 'SE', 'US']
 
+# Local FX rate table (Date, Currency, Rate) used when the workbook has no "FX Rates" sheet
+FX_RATES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fx_rates.csv')
+
+# Columns shown (and pre-sorted) in the order explorers
+OTP_EXPLORER_COLUMNS = ['TMS_Order', 'QDT', 'POD_DateTime', 'Time_Diff', 'Status', 'QC_Name']
+COST_EXPLORER_COLUMNS = ['Order_Date', 'Order_Num', 'Account_Name', 'Office', 'PU_Country', 'Currency',
+                         'Net_Revenue_Rpt', 'Total_Cost_Rpt', 'Gross_Percent', 'Invoice_Num', 'Status']
+EXPLORER_PAGE_SIZES = [25, 50, 100, 250]
+
+# SQL console limits
+SQL_PAGE_SIZE = 100
+SQL_TIMEOUT_OPTIONS = [5, 30, 120]
+SIMULATION_TRIALS = [5000, 20000, 50000]
+
+# Trend states kept per (session, workbook name), oldest dropped first
+TREND_STORE_ENTRIES = 64
+
+# Parsed workbooks shared by all sessions and server processes of this user (point every process at the same
+# directory); the store refuses a directory that other users own or can write to
+DATASET_STORE_DIR = os.environ.get('TMS_DATASET_STORE') or os.path.join(
+ os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'tms_dashboard', 'dataset_store')
+DATASET_STORE_BUDGET = int(os.environ.get('TMS_DATASET_STORE_MB', '2048')) * 1024 ** 2
+
+# Compute workers for ingestion and aggregation jobs: process count, queue depth, jobs one session may
+# run at once (and how many of a fanned-out batch, e.g. simulation chunks), CPU niceness relative to the
+# server, and per-job time limits in seconds
+COMPUTE_WORKERS = int(os.environ.get('TMS_COMPUTE_WORKERS', str(max(1, min(2, os.cpu_count() or 1)))))
+COMPUTE_MAX_QUEUED = int(os.environ.get('TMS_COMPUTE_QUEUE', '32'))
+COMPUTE_SESSION_JOBS = int(os.environ.get('TMS_COMPUTE_SESSION_JOBS', '1'))
+COMPUTE_BATCH_JOBS = int(os.environ.get('TMS_COMPUTE_BATCH_JOBS', str(COMPUTE_WORKERS)))
+COMPUTE_NICENESS = int(os.environ.get('TMS_COMPUTE_NICE', '10'))
+INGEST_JOB_TIMEOUT = float(os.environ.get('TMS_INGEST_TIMEOUT', '600'))
+COMPUTE_JOB_TIMEOUT = float(os.environ.get('TMS_JOB_TIMEOUT', '120'))
+
+# Folder the TMS drops refreshed workbooks into - when set, sessions can follow it instead of uploading
+WATCH_DIR = os.environ.get('TMS_WATCH_DIR')
+WATCH_INTERVAL = float(os.environ.get('TMS_WATCH_INTERVAL', '5'))
+
+KPI_API_HOST = os.environ.get('TMS_API_HOST', '127.0.0.1')
+KPI_API_PORT = int(os.environ.get('TMS_API_PORT', '8750'))
+
 # Complete QC Name mapping
 QC_CATEGORIES = {
 'MNX-Incorrect QDT': 'System Error',
@@ -84,118 +157,1025 @@ QC_CATEGORIES = {
 'Consignee-Changed delivery parameters': 'Delivery Issue'
 }
 
-def safe_date_conversion(date_series):
- """Safely convert Excel dates"""
- try:
-  if date_series.dtype in ['int64', 'float64']:
-   return pd.to_datetime(date_series, origin='1899-12-30', unit='D', errors='coerce')
-  else:
-   return pd.to_datetime(date_series, errors='coerce')
- except:
-  return date_series
+_cache_state = threading.local()
 
-@st.cache_data
+def tracked_cache(name, cache_decorator):
+ """Apply a Streamlit cache decorator and count hits and misses under ``name``"""
+ def decorate(func):
+  @functools.wraps(func)
+  def compute(*args, **kwargs):
+   _cache_state.miss = True
+   return func(*args, **kwargs)
+  cached = cache_decorator(compute)
+  
+  @functools.wraps(func)
+  def lookup(*args, **kwargs):
+   _cache_state.miss = False
+   result = cached(*args, **kwargs)
+   inc_metric('tms_cache_requests_total', cache=name, result='miss' if _cache_state.miss else 'hit')
+   return result
+  lookup.clear = cached.clear
+  return lookup
+ return decorate
+
+def timed_fragment(name, run_every=None):
+ """Turn a section into an ``st.fragment`` so its widgets rerun only that section, timing each run
+
+ Runs are labelled ``scope='fragment'`` when only the section reran and
+ ``scope='script'`` when it ran as part of a full script run. With
+ ``run_every`` (seconds) the section also reruns on its own at that interval.
+ """
+ def decorate(func):
+  @functools.wraps(func)
+  def run(*args, **kwargs):
+   ctx = get_script_run_ctx()
+   scope = 'fragment' if ctx is not None and ctx.fragment_ids_this_run else 'script'
+   with timed_metric('tms_fragment_run_seconds', fragment=name, scope=scope):
+    return func(*args, **kwargs)
+  return st.fragment(run, run_every=run_every)
+ return decorate
+
+@tracked_cache('load_tms_data', st.cache_resource(max_entries=16))
 def load_tms_data(uploaded_file):
- """Load and process TMS Excel file"""
+ """Load and process TMS Excel file - one shared, read-only copy per workbook in this process"""
  if uploaded_file is not None:
+  # A workbook already parsed by any session or server process is memory-mapped from the shared store
+  content = uploaded_file.getvalue()
+  dataset_hash = dataset_key(content, *ingest_settings())
+  stored = load_dataset(DATASET_STORE_DIR, dataset_hash)
+  inc_metric('tms_dataset_store_requests_total', result='miss' if stored is None else 'hit')
+  if stored is not None:
+   return stored
+  
   try:
-   excel_sheets = pd.read_excel(uploaded_file, sheet_name=None)
-   data = {}
-   
-   # 1. Raw Data
-   if "AMS RAW DATA" in excel_sheets:
-    data['raw_data'] = excel_sheets["AMS RAW DATA"].copy()
-   
-   # 2. OTP Data with QC Name processing
-   if "OTP POD" in excel_sheets:
-    otp_df = excel_sheets["OTP POD"].copy()
-    # Get first 6 columns to include QC Name
-    if len(otp_df.columns) >= 6:
-     otp_df = otp_df.iloc[:, :6]
-     otp_df.columns = ['TMS_Order', 'QDT', 'POD_DateTime', 'Time_Diff', 'Status', 'QC_Name']
-    else:
-     # Handle case with fewer columns
-     cols = ['TMS_Order', 'QDT', 'POD_DateTime', 'Time_Diff', 'Status'][:len(otp_df.columns)]
-     otp_df.columns = cols
-    otp_df = otp_df.dropna(subset=['TMS_Order'])
-    data['otp'] = otp_df
-   
-   # 3. Volume Data - process the matrix correctly
-   if "Volume per SVC" in excel_sheets:
-    volume_df = excel_sheets["Volume per SVC"].copy()
-    
-    # Service volumes by country matrix (from the Excel data shown)
-    service_country_matrix = {
-     'AT': {'CTX': 2, 'EF': 3},
-     'AU': {'CTX': 3},
-     'BE': {'CX': 5, 'EF': 2, 'ROU': 1},
-     'DE': {'CTX': 1, 'CX': 6, 'ROU': 2},
-     'DK': {'CTX': 1},
-     'ES': {'CX': 1},
-     'FR': {'CX': 8, 'EF': 2, 'EGD': 5, 'FF': 1, 'ROU': 1},
-     'GB': {'CX': 3, 'EF': 6, 'ROU': 1},
-     'IT': {'CTX': 3, 'CX': 4, 'EF': 2, 'EGD': 1, 'ROU': 2},
-     'N1': {'CTX': 1},
-     'NL': {'CTX': 1, 'CX': 1, 'EF': 7, 'EGD': 5, 'FF': 1, 'RGD': 4, 'ROU': 28},
-     'NZ': {'CTX': 3},
-     'SE': {'CX': 1},
-     'US': {'CTX': 4, 'FF': 4}
-    }
-    
-    # Calculate totals
-    service_volumes = {'CTX': 19, 'CX': 37, 'EF': 14, 'EGD': 5, 'FF': 17, 'RGD': 3, 'ROU': 30, 'SF': 0}
-    country_volumes = {'AT': 5, 'AU': 3, 'BE': 8, 'DE': 9, 'DK': 1, 'ES': 1, 'FR': 17, 
-                      'GB': 10, 'IT': 12, 'N1': 1, 'NL': 47, 'NZ': 3, 'SE': 1, 'US': 8}
-    
-    # Total volume should be 125 based on the Excel
-    total_vol = 125
-    
-    data['service_volumes'] = service_volumes
-    data['country_volumes'] = country_volumes
-    data['service_country_matrix'] = service_country_matrix
-    data['total_volume'] = total_vol
-   
-   # 4. Lane Usage - Process the actual data from Excel
-   if "Lane usage " in excel_sheets:
-    lane_df = excel_sheets["Lane usage "].copy()
-    # Based on the screenshot, the lane usage matrix shows:
-    # Origins (rows): AT, BE, CH, CN, DE, DK, FI, FR, GB, HK, IT, NL, PL
-    # Destinations (columns): AT, AU, BE, DE, DK, ES, FR, GB, IT, N1, NL, NZ, SE, US
-    data['lanes'] = lane_df
-   
-   # 5. Cost Sales - Fixed to properly process financial data
-   if "cost sales" in excel_sheets:
-    cost_df = excel_sheets["cost sales"].copy()
-    expected_cols = ['Order_Date', 'Account', 'Account_Name', 'Office', 'Order_Num', 
-                    'PU_Cost', 'Ship_Cost', 'Man_Cost', 'Del_Cost', 'Total_Cost',
-                    'Net_Revenue', 'Currency', 'Diff', 'Gross_Percent', 'Invoice_Num',
-                    'Total_Amount', 'Status', 'PU_Country']
+   # Parsed on a compute worker, which publishes the dataset to the store for this process to memory-map
+   data = run_compute_job(f'ingest:{dataset_hash}', 'ingest', ingest_workbook, ingest_args(content, dataset_hash),
+                          INGEST_JOB_TIMEOUT)
+   return data if data is not None else load_dataset(DATASET_STORE_DIR, dataset_hash)
+  except Exception as e:
+   # Raised rather than returned, so a failed or timed-out load is not cached and the next rerun retries
+   raise RuntimeError(f"Error processing Excel file: {str(e)}") from e
+ return None
+
+def ingest_settings():
+ """Everything besides the workbook bytes that the parsed dataset depends on"""
+ return OTP_EXPLORER_COLUMNS, COST_EXPLORER_COLUMNS, list(QC_CATEGORIES), FX_RATES_FILE
+
+def ingest_args(content, dataset_hash, previous_hash=None):
+ """Arguments of an ingest job - with ``previous_hash``, sheets unchanged since that stored version are reused"""
+ return (DATASET_STORE_DIR, DATASET_STORE_BUDGET, content, dataset_hash, previous_hash) + ingest_settings()
+
+def read_workbook(uploaded_file):
+ """Cached workbook load, showing the error and returning None when it fails"""
+ try:
+  return load_tms_data(uploaded_file)
+ except Exception as e:
+  st.error(str(e))
+  return None
+
+@st.cache_resource
+def get_compute_pool():
+ """Compute worker processes shared by all sessions, separate from the server's script threads"""
+ return new_compute_pool(COMPUTE_WORKERS, COMPUTE_MAX_QUEUED, COMPUTE_SESSION_JOBS, COMPUTE_NICENESS)
+
+def run_compute_job(key, kind, func, args, timeout):
+ """Submit a job on behalf of this session and poll until it finishes"""
+ ctx = get_script_run_ctx()
+ job = submit_job(get_compute_pool(), key, kind, func, args, timeout, owner=ctx.session_id if ctx else None)
+ return wait_for_job(job)
+
+def run_compute_jobs(key, kind, func, arg_list, timeout):
+ """Fan one job per argument tuple out on behalf of this session, up to COMPUTE_BATCH_JOBS at once; results in order"""
+ ctx = get_script_run_ctx()
+ return run_jobs(get_compute_pool(), key, kind, func, arg_list, timeout, owner=ctx.session_id if ctx else None,
+                 owner_limit=COMPUTE_BATCH_JOBS)
+
+def ingest_watched_workbook(pool, path, content, previous):
+ """Folder watcher callback: ingest a new or changed workbook on the compute workers
+
+ Runs on the watcher thread, so the pool is passed in rather than looked up.
+ Only the sheets that changed since ``previous`` (this file's last entry) are
+ parsed again.
+ """
+ dataset_hash = dataset_key(content, *ingest_settings())
+ data = load_dataset(DATASET_STORE_DIR, dataset_hash)
+ if data is None:
+  previous_hash = previous['dataset_hash'] if previous else None
+  job = submit_job(pool, f'ingest:{dataset_hash}', 'ingest', ingest_workbook,
+                   ingest_args(content, dataset_hash, previous_hash), INGEST_JOB_TIMEOUT, owner='folder-watcher')
+  data = wait_for_job(job)
+  if data is None:
+   data = load_dataset(DATASET_STORE_DIR, dataset_hash)
+ return {'name': os.path.basename(path), 'dataset_hash': dataset_hash, 'data': data,
+         'modified': os.path.getmtime(path), 'refreshed': datetime.now()}
+
+@st.cache_resource
+def get_folder_watcher():
+ """Watcher over WATCH_DIR shared by all sessions - each changed workbook is ingested once"""
+ return new_folder_watcher(WATCH_DIR, functools.partial(ingest_watched_workbook, get_compute_pool()), WATCH_INTERVAL)
+
+@timed_fragment('folder_watch', run_every=WATCH_INTERVAL)
+def render_folder_watch(watcher, path, dataset_hash, paths):
+ """Checks the watcher every few seconds and reruns the app once the followed workbook was refreshed"""
+ entry = watcher['files'].get(path)
+ if (entry is not None and entry['dataset_hash'] != dataset_hash) or sorted(watcher['files']) != paths:
+  st.rerun()
+ for error_path, error in list(watcher['errors'].items()):
+  st.error(f"{os.path.basename(error_path)}: {error}")
+ st.caption(f"Watching {watcher['directory']} · checked {datetime.now():%H:%M:%S}")
+
+def run_on_dataset(tms_data, kind, func, frame_names, *args):
+ """``func(*frames, *args)`` on a compute worker over the stored dataset - inline when the store is unavailable"""
+ dataset_hash = tms_data['dataset_hash']
+ if save_dataset(DATASET_STORE_DIR, dataset_hash, tms_data, DATASET_STORE_BUDGET) is None:
+  return func(*[tms_data.get(name) for name in frame_names], *args)
+ return run_compute_job(f'{kind}:{dataset_hash}:{args!r}', kind, dataset_job,
+                        (DATASET_STORE_DIR, dataset_hash, func, frame_names, *args), COMPUTE_JOB_TIMEOUT)
+
+@tracked_cache('compute_lane_network', st.cache_data)
+def compute_lane_network(lanes_df, hub='NL'):
+ """Cached hub-structure metrics for a lane table"""
+ return lane_network_metrics(lanes_df, hub)
+
+@tracked_cache('compute_consolidation', st.cache_data)
+def compute_consolidation(dataset_hash, _tms_data, window_hours, lane_level):
+ """Cached consolidation candidates for one window and lane level"""
+ return run_on_dataset(_tms_data, 'consolidation', find_consolidation_candidates, ('raw_data', 'cost_sales'),
+                       window_hours, lane_level)
+
+def render_downloads(name, frame, key):
+ """CSV and Excel download buttons - files are generated only on click, off the script thread
+
+ ``frame`` may be a DataFrame or a zero-argument callable returning one, so
+ large filtered extracts are not materialized unless someone downloads them.
+ """
+ get_frame = frame if callable(frame) else (lambda: frame)
+ col1, col2, _ = st.columns([1, 1, 4])
+ 
+ with col1:
+  st.download_button("⬇️ CSV", lambda: csv_export(get_frame()), file_name=f"{name}.csv", mime='text/csv',
+                     key=f'{key}_csv', on_click='ignore')
+ 
+ with col2:
+  st.download_button("⬇️ Excel", lambda: excel_export({name: get_frame()}), file_name=f"{name}.xlsx",
+                     mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                     key=f'{key}_xlsx', on_click='ignore')
+
+@timed_fragment('order_explorer')
+def render_order_explorer(name, df, sort_index, dataset_hash, filter_label='All orders', filter_key=None, mask=None):
+ """Server-side paginated order table - only the visible page is sent to the browser"""
+ columns = [col for col in sort_index if col in df.columns]
+ if not columns:
+  return
+ 
+ col1, col2, col3, col4 = st.columns([2, 1, 1, 1])
+ 
+ with col1:
+  st.markdown(f"**{filter_label}**")
+ 
+ with col2:
+  sort_col = st.selectbox("Sort by", columns, key=f'{name}_explorer_sort')
+ 
+ with col3:
+  descending = st.toggle("Descending", value=False, key=f'{name}_explorer_desc')
+ 
+ with col4:
+  page_size = st.selectbox("Rows per page", EXPLORER_PAGE_SIZES, key=f'{name}_explorer_page_size')
+ 
+ # Ordered positions are kept per (dataset, filter, sort) so page turns are a plain slice
+ explorer_cache = st.session_state.setdefault('explorer_positions', {})
+ cache_key = (dataset_hash, name, filter_key, sort_col, descending)
+ if cache_key not in explorer_cache:
+  if len(explorer_cache) >= 8:
+   explorer_cache.pop(next(iter(explorer_cache)))
+  explorer_cache[cache_key] = explorer_positions(sort_index, sort_col, descending, mask)
+ positions = explorer_cache[cache_key]
+ 
+ total_rows = len(positions)
+ total_pages = max(1, -(-total_rows // page_size))
+ page_key = f'{name}_explorer_page'
+ if st.session_state.get(f'{name}_explorer_view') != cache_key:
+  st.session_state[f'{name}_explorer_view'] = cache_key
+  st.session_state[page_key] = 1
+ page = st.number_input(f"Page (of {total_pages:,})", min_value=1, max_value=total_pages, step=1, key=page_key)
+ 
+ page_rows = df.iloc[positions[(page - 1) * page_size:page * page_size]][columns]
+ st.dataframe(page_rows, hide_index=True, use_container_width=True)
+ st.markdown(f"<small>Rows {min((page - 1) * page_size + 1, total_rows):,}–{min(page * page_size, total_rows):,} "
+             f"of {total_rows:,}</small>", unsafe_allow_html=True)
+ render_downloads(f'{name}_orders', lambda: df.iloc[positions], f'{name}_explorer_download')
+
+@st.cache_resource(max_entries=8)
+def get_pivot_cache(dataset_hash):
+ """Partial pivot aggregates for one dataset, shared across reruns and sessions"""
+ return new_pivot_cache()
+
+@st.cache_resource
+def get_trend_store():
+ """Materialized trend states per session and workbook name, kept across re-uploads of that workbook"""
+ return {'lock': threading.Lock(), 'entries': {}}
+
+def get_trend_states(tms_data, source_name):
+ """Rolling trend states for this dataset - extended incrementally when a re-upload only appends days
+
+ Keyed by session as well as file name, so two users uploading different
+ workbooks with the same name never extend each other's history.
+ """
+ trend_store = get_trend_store()
+ ctx = get_script_run_ctx()
+ key = (ctx.session_id if ctx else None, source_name)
+ with trend_store['lock']:
+  entry = trend_store['entries'].get(key)
+ if entry and entry['dataset_hash'] == tms_data['dataset_hash']:
+  return entry['states']
+ 
+ states = {}
+ for breakdown, col in TREND_BREAKDOWNS.items():
+  previous = entry['states'].get(breakdown) if entry else None
+  states[breakdown] = refresh_trend_state(previous, daily_matrix(tms_data['daily_rollup'], col))
+ with trend_store['lock']:
+  entries = trend_store['entries']
+  entries.pop(key, None)
+  if len(entries) >= TREND_STORE_ENTRIES:
+   entries.pop(next(iter(entries)))
+  entries[key] = {'dataset_hash': tms_data['dataset_hash'], 'states': states}
+ return states
+
+@tracked_cache('compute_sla_otp', st.cache_data(max_entries=16))
+def compute_sla_otp(dataset_hash, _tms_data, grace_hours, business_days, delivery_window):
+ """OTP orders re-scored under a custom SLA, cached per dataset and SLA settings"""
+ sla = {'grace_hours': grace_hours, 'business_days': business_days, 'delivery_window': delivery_window}
+ return run_on_dataset(_tms_data, 'sla', sla_lateness, ('otp', 'raw_data'), sla)
+
+@tracked_cache('compute_demand_forecast', st.cache_data(max_entries=16))
+def compute_demand_forecast(dataset_hash, _tms_data, granularity, horizon):
+ """Forecast bands for all service x country series, cached per dataset and settings"""
+ # Volume falls back to OTP order counts when the raw sheet has no pickup dates
+ measure = 'Shipments' if _tms_data['daily_rollup']['Shipments'].sum() > 0 else 'Orders'
+ return run_on_dataset(_tms_data, 'forecast', demand_forecast, ('daily_rollup',), granularity, horizon, measure)
+
+@tracked_cache('get_lane_profiles', st.cache_data(max_entries=8))
+def get_lane_profiles(dataset_hash, _tms_data):
+ """Per-lane delay distributions and order economics, built once per dataset"""
+ return run_on_dataset(_tms_data, 'lane_profiles', build_lane_profiles, ('otp', 'raw_data', 'cost_sales'))
+
+@tracked_cache('simulate_scenario', st.cache_data(max_entries=64))
+def simulate_scenario(dataset_hash, scenario_items, trials, _profiles):
+ """Monte Carlo trials for one scenario, cached per dataset, scenario and trial count"""
+ # One compute job per chunk of trials, spread over the workers
+ key = f'simulation:{dataset_hash}:{scenario_items!r}:{trials}'
+ totals = run_simulation(_profiles, dict(scenario_items), trials,
+                         lambda func, arg_list: run_compute_jobs(key, 'simulation', func, arg_list, COMPUTE_JOB_TIMEOUT))
+ return summarize_simulation(totals), totals['otp'], totals['margin']
+
+@st.cache_resource
+def get_export_jobs():
+ """Background export builds keyed by dataset hash, shared across sessions"""
+ return {'executor': ThreadPoolExecutor(max_workers=2), 'lock': threading.Lock(), 'jobs': {}}
+
+def get_report_export(dataset_hash, build=None, *args):
+ """Existing export job for this dataset, or a new background job when ``build`` is given"""
+ exports = get_export_jobs()
+ with exports['lock']:
+  job = exports['jobs'].get(dataset_hash)
+  if job is None and build is not None:
+   if len(exports['jobs']) >= 8:
+    exports['jobs'].pop(next(iter(exports['jobs'])))
+   job = exports['jobs'][dataset_hash] = exports['executor'].submit(build, *args)
+  return job
+
+def executive_report_figures(tms_data):
+ """Key charts for the exported executive report"""
+ figures = []
+ if tms_data.get('service_volumes'):
+  service_data = pd.DataFrame(list(tms_data['service_volumes'].items()), columns=['Service', 'Volume'])
+  fig = px.bar(service_data[service_data['Volume'] > 0], x='Service', y='Volume', color_discrete_sequence=['#3182bd'])
+  figures.append(('Shipments by Service', fig))
+ if tms_data.get('country_volumes'):
+  country_data = pd.DataFrame(list(tms_data['country_volumes'].items()), columns=['Country', 'Volume'])
+  fig = px.bar(country_data.sort_values('Volume', ascending=False), x='Country', y='Volume',
+               color_discrete_sequence=['#31a354'])
+  figures.append(('Shipments by Country', fig))
+ if 'otp' in tms_data and 'Status' in tms_data['otp'].columns:
+  status_counts = tms_data['otp']['Status'].value_counts()
+  fig = px.pie(values=status_counts.values, names=status_counts.index, color=status_counts.index,
+               color_discrete_map={'ON TIME': '#2ca02c', 'LATE': '#d62728'})
+  figures.append(('On-Time vs Late Orders', fig))
+ if tms_data.get('financial_base') is not None:
+  country_financials = rollup_financials(tms_data['financial_base'], ['Country']).reset_index()
+  fig = px.bar(country_financials, x='PU_Country', y=['Net_Revenue', 'Total_Cost'], barmode='group',
+               labels={'PU_Country': 'Country', 'value': f'Amount ({CURRENCY_LABEL})', 'variable': ''})
+  figures.append(('Revenue and Cost by Country', fig))
+ return figures
+
+def build_report_export(title, meta, kpis, sections, tms_data):
+ """Executive report as a self-contained HTML file - runs on the export worker"""
+ figures = executive_report_figures(tms_data)
+ return build_report_html(title, meta, kpis, sections, figures, get_plotlyjs()).encode('utf-8')
+
+@tracked_cache('generate_batch_reports', st.cache_data(max_entries=16, show_spinner="Rendering batch reports across worker processes..."))
+def generate_batch_reports(jobs):
+ """Render one snapshot per (dataset_hash, unit_column, unit, label) job across the compute workers
+
+ All units are submitted at once and rendered in parallel, up to
+ COMPUTE_BATCH_JOBS at a time; the queue cap throttles very large batches.
+ Workers read the parsed frames from the shared Arrow cache; returns a KPI
+ summary table and a zip archive of the HTML reports.
+ """
+ reports = run_compute_jobs(f'report:{jobs!r}', 'report', render_unit_report, [(DATASET_STORE_DIR, *job) for job in jobs],
+                            COMPUTE_JOB_TIMEOUT)
+ summary = []
+ archive = io.BytesIO()
+ with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as bundle:
+  for label, kpis, report in reports:
+   summary.append({'Unit': label, **kpis})
+   bundle.writestr(f"tms_snapshot_{''.join(c if c.isalnum() else '_' for c in label)}.html", report)
+ return pd.DataFrame(summary), archive.getvalue()
+
+@st.cache_resource
+def get_kpi_api():
+ """KPI store and the local JSON API serving it - one per server process
+
+ Returns (store, server, error); when the port cannot be bound the server is
+ None and the error is shown in the sidebar and counted in the metrics.
+ """
+ store = new_kpi_store()
+ try:
+  return store, start_kpi_server(store, KPI_API_HOST, KPI_API_PORT), None
+ except OSError as e:
+  inc_metric('tms_api_start_errors_total')
+  return store, None, f"KPI API could not listen on {KPI_API_HOST}:{KPI_API_PORT} ({e.strerror or e}) - set TMS_API_PORT"
+
+@timed_fragment('order_search')
+def render_order_search(search_index):
+ """Sidebar order lookup - each keystroke reruns only the search box and its matches"""
+ search_query = st.text_input("🔎 Find order, invoice or account", placeholder="Start typing an ID or name",
+                              key='order_search')
+ search_result = search_orders(search_index, search_query)
+ if search_result:
+  matches, match_count = search_result
+  if match_count:
+   result_cols = [col for col in ['Order', 'Status', 'QC_Name', 'Margin_Percent', 'Account_Name', 'Matched_On']
+                  if col in matches.columns]
+   st.dataframe(matches[result_cols].rename(columns={'QC_Name': 'QC Reason', 'Margin_Percent': 'Margin %',
+                                                     'Account_Name': 'Account', 'Matched_On': 'Matched'}),
+                hide_index=True, use_container_width=True)
+   st.caption(f"{match_count:,} matches" + (f" - showing first {len(matches)}" if match_count > len(matches) else ""))
+  else:
+   st.caption("No matching orders")
+
+@timed_fragment('scenario_simulator')
+def render_scenario_simulator(tms_data):
+ """Monte Carlo scenario form and risk bands - reruns on its own when the form is submitted"""
+ if 'otp' in tms_data and {'QDT', 'POD_DateTime'}.issubset(tms_data['otp'].columns):
+  lane_profiles = get_lane_profiles(tms_data['dataset_hash'], tms_data)
+  
+  if lane_profiles is not None:
+   st.markdown('<p class="chart-title">Scenario Simulator - OTP and Margin Risk</p>', unsafe_allow_html=True)
+   
+   with st.form('scenario_form'):
+    col1, col2, col3 = st.columns(3)
     
-    new_cols = expected_cols[:len(cost_df.columns)]
-    cost_df.columns = new_cols
+    with col1:
+     hub_growth = st.slider("Volume growth on NL lanes (%)", -50, 200, 0, step=5)
+     other_growth = st.slider("Volume growth on other lanes (%)", -50, 200, 0, step=5)
     
-    if 'Order_Date' in cost_df.columns:
-     cost_df['Order_Date'] = safe_date_conversion(cost_df['Order_Date'])
+    with col2:
+     price_change = st.slider("Price change (%)", -30, 30, 0)
+     cost_change = st.slider("Cost change (%)", -30, 30, 0)
     
-    # Clean financial data - remove rows with missing financial values
-    if 'Net_Revenue' in cost_df.columns and 'Total_Cost' in cost_df.columns:
-     cost_df = cost_df.dropna(subset=['Net_Revenue', 'Total_Cost'])
-     # Only keep rows with actual financial activity
-     cost_df = cost_df[(cost_df['Net_Revenue'] != 0) | (cost_df['Total_Cost'] != 0)]
+    with col3:
+     capacity_headroom = st.slider("Spare capacity before delays grow (%)", 0, 100, int(DEFAULT_SCENARIO['capacity_headroom']))
+     delay_per_10pct = st.slider("Extra delay per 10% over capacity (days)", 0.0, 2.0,
+                                 float(DEFAULT_SCENARIO['delay_per_10pct']), step=0.05)
     
-    data['cost_sales'] = cost_df
+    trials = st.select_slider("Trials", SIMULATION_TRIALS, value=SIMULATION_TRIALS[1])
+    st.form_submit_button("Run Simulation")
    
-   return data
+   scenario = {'hub': 'NL', 'hub_growth': float(hub_growth), 'other_growth': float(other_growth),
+               'price_change': float(price_change), 'cost_change': float(cost_change),
+               'capacity_headroom': float(capacity_headroom), 'delay_per_10pct': float(delay_per_10pct)}
+   baseline_summary, _, _ = simulate_scenario(tms_data['dataset_hash'], tuple(sorted(DEFAULT_SCENARIO.items())),
+                                              trials, lane_profiles)
+   scenario_summary, simulated_otp, simulated_margin = simulate_scenario(
+    tms_data['dataset_hash'], tuple(sorted(scenario.items())), trials, lane_profiles)
    
-  except Exception as e:
-   st.error(f"Error processing Excel file: {str(e)}")
-   return None
- return None
+   col1, col2, col3, col4 = st.columns(4)
+   
+   with col1:
+    st.metric("Projected OTP (P50)", f"{scenario_summary.loc['OTP %', 'P50']:.1f}%",
+              f"{scenario_summary.loc['OTP %', 'P50'] - baseline_summary.loc['OTP %', 'P50']:+.1f} pp vs today")
+   
+   with col2:
+    st.metric("OTP Range (P5–P95)", f"{scenario_summary.loc['OTP %', 'P5']:.1f}–{scenario_summary.loc['OTP %', 'P95']:.1f}%")
+   
+   with col3:
+    st.metric("Projected Margin (P50)", f"{scenario_summary.loc['Margin %', 'P50']:.1f}%",
+              f"{scenario_summary.loc['Margin %', 'P50'] - baseline_summary.loc['Margin %', 'P50']:+.1f} pp vs today")
+   
+   with col4:
+    profit_delta = scenario_summary.loc['Profit', 'P50'] - baseline_summary.loc['Profit', 'P50']
+    st.metric("Projected Profit (P50)", f"{CURRENCY_SYMBOL}{scenario_summary.loc['Profit', 'P50']:,.0f}",
+              f"{'+' if profit_delta >= 0 else '-'}{CURRENCY_SYMBOL}{abs(profit_delta):,.0f}")
+   
+   col1, col2 = st.columns(2)
+   
+   with col1:
+    fig = px.histogram(x=simulated_otp, nbins=50, title='', labels={'x': 'Simulated OTP %'})
+    fig.add_vline(x=95, line_dash="dash", line_color="green", annotation_text="Target 95%")
+    fig.update_layout(height=320, showlegend=False, yaxis_title='Trials')
+    st.plotly_chart(fig, use_container_width=True)
+   
+   with col2:
+    fig = px.histogram(x=simulated_margin, nbins=50, title='', labels={'x': 'Simulated Margin %'},
+                       color_discrete_sequence=['#31a354'])
+    fig.update_layout(height=320, showlegend=False, yaxis_title='Trials')
+    st.plotly_chart(fig, use_container_width=True)
+   
+   st.markdown(f"<small>{trials:,} trials over {len(lane_profiles['volume']):,} lanes; P(OTP ≥ 95%) = "
+               f"{(simulated_otp >= 95).mean() * 100:.1f}%</small>", unsafe_allow_html=True)
+
+@timed_fragment('demand_forecast')
+def render_demand_forecast(tms_data):
+ """Forecast controls and bands for the selected service x country series"""
+ if 'daily_rollup' in tms_data and not tms_data['daily_rollup'].empty:
+  st.markdown('<p class="chart-title">Demand Forecast by Service & Country</p>', unsafe_allow_html=True)
+  
+  col1, col2 = st.columns(2)
+  
+  with col1:
+   forecast_granularity = st.radio("Granularity", ['Daily', 'Weekly', 'Monthly'], index=1, horizontal=True,
+                                   key='forecast_granularity')
+  
+  with col2:
+   forecast_horizon = st.slider("Horizon (periods)", 1, 26, 8, key='forecast_horizon')
+  
+  forecast_data, forecast_summary = compute_demand_forecast(tms_data['dataset_hash'], tms_data,
+                                                            forecast_granularity[0], forecast_horizon)
+  
+  if forecast_summary.empty:
+   st.info("Not enough dated history to fit a forecast at this granularity")
+  else:
+   series_options = forecast_summary['Series'].tolist()
+   forecast_series = st.multiselect("Series (Service | Country)", series_options, default=series_options[:4],
+                                    key='forecast_series')
+   
+   fig = go.Figure()
+   for idx, name in enumerate(forecast_series):
+    color = px.colors.qualitative.Plotly[idx % len(px.colors.qualitative.Plotly)]
+    series_data = forecast_data[forecast_data['Series'] == name]
+    history = series_data.dropna(subset=['Volume'])
+    projected = series_data.dropna(subset=['Forecast'])
+    fig.add_trace(go.Scatter(x=history['Date'], y=history['Volume'], name=name, line=dict(color=color)))
+    fig.add_trace(go.Scatter(x=pd.concat([projected['Date'], projected['Date'][::-1]]),
+                             y=pd.concat([projected['Upper'], projected['Lower'][::-1]]),
+                             fill='toself', fillcolor=color, opacity=0.15, line=dict(width=0),
+                             hoverinfo='skip', showlegend=False))
+    fig.add_trace(go.Scatter(x=projected['Date'], y=projected['Forecast'], name=f"{name} (forecast)",
+                             line=dict(color=color, dash='dash')))
+   fig.update_layout(height=450, xaxis_title='', yaxis_title='Volume')
+   st.plotly_chart(fig, use_container_width=True)
+   
+   display_summary = forecast_summary.head(20).copy()
+   display_summary[['Next Period', 'Horizon Total']] = display_summary[['Next Period', 'Horizon Total']].round(1)
+   st.dataframe(display_summary, hide_index=True, use_container_width=True)
+   st.markdown(f"<small>{len(series_options):,} series fitted with damped-trend exponential smoothing; "
+               f"bands are approximate 95% prediction intervals</small>", unsafe_allow_html=True)
+
+@timed_fragment('trends')
+def render_trends(tms_data, source_name):
+ """OTP and volume trend charts for the chosen granularity, breakdown and rolling window"""
+ if 'daily_rollup' in tms_data:
+  st.markdown('<p class="chart-title">OTP and Volume Trends</p>', unsafe_allow_html=True)
+  
+  trend_states = get_trend_states(tms_data, source_name)
+  
+  col1, col2, col3 = st.columns(3)
+  
+  with col1:
+   granularity = st.radio("Granularity", ['Daily', 'Weekly', 'Monthly'], horizontal=True, key='trend_granularity')
+  
+  with col2:
+   trend_breakdown = st.radio("Breakdown", list(TREND_BREAKDOWNS), horizontal=True, key='trend_breakdown')
+  
+  with col3:
+   rolling_options = ['None'] + [f'{w}-day' for w in ROLLING_WINDOWS]
+   rolling_choice = st.radio("Rolling window", rolling_options, index=1, horizontal=True, key='trend_rolling',
+                             disabled=granularity != 'Daily')
+  
+  rolling_window = int(rolling_choice.split('-')[0]) if granularity == 'Daily' and rolling_choice != 'None' else None
+  trend_data = trend_frame(trend_states[trend_breakdown], granularity[0], rolling_window)
+  
+  # Keep the charts readable - largest series only
+  top_series = trend_data.groupby('Series')['Volume'].sum().nlargest(8).index
+  trend_data = trend_data[trend_data['Series'].isin(top_series)]
+  window_label = f" ({rolling_window}-day rolling)" if rolling_window else ""
+  
+  col1, col2 = st.columns(2)
+  
+  with col1:
+   st.markdown(f"**OTP %{window_label}**")
+   fig = px.line(trend_data, x='Date', y='OTP %', color='Series', title='')
+   fig.add_hline(y=95, line_dash="dash", line_color="green", annotation_text="Target 95%")
+   fig.update_layout(height=380, legend_title_text=trend_breakdown)
+   st.plotly_chart(fig, use_container_width=True)
+  
+  with col2:
+   st.markdown(f"**Volume{window_label}**")
+   fig = px.line(trend_data, x='Date', y='Volume', color='Series', title='')
+   fig.update_layout(height=380, legend_title_text=trend_breakdown)
+   st.plotly_chart(fig, use_container_width=True)
+
+@timed_fragment('sla_recalculation')
+def render_sla_recalculation(tms_data, otp_df):
+ """SLA controls with the recalculated OTP metrics, lateness histogram and country table"""
+ if 'QDT' in otp_df.columns and 'POD_DateTime' in otp_df.columns:
+  st.markdown('<p class="chart-title">SLA Lateness Recalculation</p>', unsafe_allow_html=True)
+  
+  col1, col2, col3 = st.columns(3)
+  
+  with col1:
+   grace_hours = st.slider("Grace period (hours)", 0, 48, 0, key='sla_grace_hours')
+  
+  with col2:
+   business_days = st.checkbox("Count business days only (destination country calendar)", key='sla_business_days')
+   use_window = st.checkbox("Apply delivery-hour window", key='sla_use_window')
+  
+  with col3:
+   delivery_window = st.slider("Delivery window (hour of day)", 0, 24, (8, 18), key='sla_delivery_window',
+                               disabled=not use_window)
+  
+  sla_df = compute_sla_otp(tms_data['dataset_hash'], tms_data, float(grace_hours),
+                           business_days, tuple(delivery_window) if use_window else None)
+  scored = sla_df.dropna(subset=['SLA_Status'])
+  
+  if not scored.empty:
+   sla_otp = (scored['SLA_Status'] == 'ON TIME').mean() * 100
+   reported = scored['Reported_Status'].dropna()
+   reported_otp = (reported == 'ON TIME').mean() * 100 if len(reported) else None
+   flipped = scored[scored['Reported_Status'].notna() & (scored['Reported_Status'] != scored['SLA_Status'])]
+   
+   col1, col2, col3, col4 = st.columns(4)
+   
+   with col1:
+    st.metric("Recalculated OTP", f"{sla_otp:.1f}%",
+              f"{sla_otp - reported_otp:+.1f} pp vs reported" if reported_otp is not None else None)
+   
+   with col2:
+    st.metric("Reported OTP", f"{reported_otp:.1f}%" if reported_otp is not None else "n/a")
+   
+   with col3:
+    st.metric("Late → On Time", f"{(flipped['SLA_Status'] == 'ON TIME').sum():,}")
+   
+   with col4:
+    st.metric("On Time → Late", f"{(flipped['SLA_Status'] == 'LATE').sum():,}")
+   
+   col1, col2 = st.columns(2)
+   
+   with col1:
+    st.markdown("**Lateness Distribution (SLA)**")
+    lateness_clean = scored['Lateness_Days'].clip(-10, 10)
+    fig = px.histogram(lateness_clean, nbins=40, title='',
+                       labels={'value': 'Days (negative = early)', 'count': 'Orders'})
+    fig.add_vline(x=0, line_dash="dash", line_color="red")
+    fig.update_layout(height=350, showlegend=False)
+    st.plotly_chart(fig, use_container_width=True)
+   
+   with col2:
+    st.markdown("**OTP by Destination Country (SLA vs Reported)**")
+    by_country = scored.assign(
+     SLA_On_Time=scored['SLA_Status'] == 'ON TIME',
+     Reported_On_Time=scored['Reported_Status'] == 'ON TIME'
+    ).groupby('Country').agg(Orders=('SLA_Status', 'size'), SLA_OTP=('SLA_On_Time', 'mean'),
+                             Reported_OTP=('Reported_On_Time', 'mean'))
+    by_country[['SLA_OTP', 'Reported_OTP']] = (by_country[['SLA_OTP', 'Reported_OTP']] * 100).round(1)
+    by_country = by_country.sort_values('Orders', ascending=False)
+    by_country.columns = ['Orders', 'SLA OTP (%)', 'Reported OTP (%)']
+    st.dataframe(by_country, use_container_width=True, height=350)
+    render_downloads('otp_sla_by_country', by_country, 'sla_country_download')
+
+@timed_fragment('margin_drilldown')
+def render_margin_drilldown(financial_base):
+ """Margin chart and table for the chosen dimension and country"""
+ if financial_base is not None:
+  st.markdown('<p class="chart-title">Margin Drill-Down by Account, Office, Month and Service</p>', unsafe_allow_html=True)
+  
+  available_dimensions = [dim for dim, col in FINANCIAL_DIMENSIONS.items()
+                          if col in financial_base.columns and dim != 'Country']
+  if available_dimensions:
+   col1, col2 = st.columns([1, 3])
+   
+   with col1:
+    margin_dimension = st.selectbox("Break down by", available_dimensions, key='margin_dimension')
+    margin_country = st.selectbox("Country", ['All'] + sorted(financial_base['PU_Country'].unique()),
+                                  key='margin_country') if 'PU_Country' in financial_base.columns else 'All'
+   
+   margin_base = financial_base if margin_country == 'All' else financial_base[financial_base['PU_Country'] == margin_country]
+   margin_rollup = rollup_financials(margin_base, [margin_dimension])
+   if margin_dimension == 'Month':
+    margin_rollup = margin_rollup.sort_index()
+   else:
+    margin_rollup = margin_rollup.head(20)
+   
+   with col2:
+    margin_chart = margin_rollup.reset_index()
+    dimension_col = margin_chart.columns[0]
+    fig = px.bar(margin_chart, x=dimension_col, y='Net_Revenue',
+               color='Margin_Percent',
+               color_continuous_scale='RdYlGn',
+               color_continuous_midpoint=20,
+               labels={dimension_col: margin_dimension, 'Net_Revenue': f'Revenue ({CURRENCY_LABEL})', 'Margin_Percent': 'Margin %'},
+               title='')
+    fig.update_layout(height=400, xaxis_tickangle=-45)
+    st.plotly_chart(fig, use_container_width=True)
+   
+   margin_table = margin_rollup[['Orders', 'Net_Revenue', 'Total_Cost', 'Profit', 'Margin_Percent']].round(0)
+   margin_table['Margin_Percent'] = margin_rollup['Margin_Percent']
+   margin_table.columns = ['Orders', f'Revenue ({CURRENCY_LABEL})', f'Cost ({CURRENCY_LABEL})', f'Profit ({CURRENCY_LABEL})', 'Margin (%)']
+   st.dataframe(margin_table, use_container_width=True)
+   render_downloads(f'margins_by_{margin_dimension.lower()}', margin_table, 'margin_download')
+
+@timed_fragment('whatif')
+def render_whatif(financial_base):
+ """Price and cost sliders with the what-if revenue, profit and margin"""
+ if financial_base is not None:
+  st.markdown('<p class="chart-title">What-If Pricing and Cost Simulator</p>', unsafe_allow_html=True)
+  
+  price_dimensions = [dim for dim in ['Country', 'Service'] if FINANCIAL_DIMENSIONS[dim] in financial_base.columns]
+  cost_components = {'PU_Cost': 'Pickup', 'Ship_Cost': 'Shipping', 'Man_Cost': 'Manual handling', 'Del_Cost': 'Delivery'}
+  cost_components = {col: label for col, label in cost_components.items() if col in financial_base.columns}
+  
+  col1, col2 = st.columns(2)
+  
+  with col1:
+   st.markdown("**Price changes**")
+   global_price_change = st.slider("All prices (%)", -30, 30, 0, key='whatif_price_all')
+   price_changes = {}
+   if price_dimensions:
+    price_dimension = st.radio("Adjust prices by", price_dimensions, horizontal=True, key='whatif_price_dimension')
+    price_col = FINANCIAL_DIMENSIONS[price_dimension]
+    price_values = financial_base.groupby(price_col)['Net_Revenue'].sum().sort_values(ascending=False).index.tolist()
+    price_targets = st.multiselect(f"{price_dimension} overrides", price_values, key='whatif_price_targets')
+    for value in price_targets:
+     price_changes[value] = st.slider(f"{value} (%)", -30, 30, 0, key=f'whatif_price_{price_dimension}_{value}')
+   else:
+    price_dimension = 'Country'
+  
+  with col2:
+   st.markdown("**Cost component changes**")
+   cost_changes = {col: st.slider(f"{label} cost (%)", -30, 30, 0, key=f'whatif_{col}')
+                   for col, label in cost_components.items()}
+  
+  whatif_start = time.perf_counter()
+  adjusted_base = whatif_financials(financial_base, price_dimension, price_changes, global_price_change, cost_changes)
+  current_total = financial_base[['Net_Revenue', 'Total_Cost']].sum()
+  whatif_total = adjusted_base[['Net_Revenue', 'Total_Cost']].sum()
+  current_country = rollup_financials(financial_base, ['Country'])
+  whatif_country = rollup_financials(adjusted_base, ['Country']).reindex(current_country.index)
+  current_account = rollup_financials(financial_base, ['Account']).head(20) if 'Account_Name' in financial_base.columns else None
+  whatif_elapsed = (time.perf_counter() - whatif_start) * 1000
+  
+  current_profit = current_total['Net_Revenue'] - current_total['Total_Cost']
+  whatif_profit = whatif_total['Net_Revenue'] - whatif_total['Total_Cost']
+  current_margin = current_profit / current_total['Net_Revenue'] * 100 if current_total['Net_Revenue'] else 0
+  whatif_margin = whatif_profit / whatif_total['Net_Revenue'] * 100 if whatif_total['Net_Revenue'] else 0
+  
+  col1, col2, col3 = st.columns(3)
+  
+  with col1:
+   st.metric("What-If Revenue", f"{CURRENCY_SYMBOL}{whatif_total['Net_Revenue']:,.0f}",
+             f"{whatif_total['Net_Revenue'] - current_total['Net_Revenue']:+,.0f}")
+  
+  with col2:
+   st.metric("What-If Profit", f"{CURRENCY_SYMBOL}{whatif_profit:,.0f}", f"{whatif_profit - current_profit:+,.0f}")
+  
+  with col3:
+   st.metric("What-If Margin", f"{whatif_margin:.1f}%", f"{whatif_margin - current_margin:+.1f} pp")
+  
+  col1, col2 = st.columns(2)
+  
+  with col1:
+   st.markdown("**By Country**")
+   country_whatif = pd.DataFrame({
+    f'Profit ({CURRENCY_LABEL})': current_country['Profit'].round(0),
+    f'What-If Profit ({CURRENCY_LABEL})': whatif_country['Profit'].round(0),
+    'Margin (%)': current_country['Margin_Percent'],
+    'What-If Margin (%)': whatif_country['Margin_Percent']
+   })
+   st.dataframe(country_whatif, use_container_width=True, height=350)
+  
+  with col2:
+   if current_account is not None:
+    st.markdown("**Top 20 Accounts by Revenue**")
+    whatif_account = rollup_financials(adjusted_base, ['Account']).reindex(current_account.index)
+    account_whatif = pd.DataFrame({
+     f'Profit ({CURRENCY_LABEL})': current_account['Profit'].round(0),
+     f'What-If Profit ({CURRENCY_LABEL})': whatif_account['Profit'].round(0),
+     'Margin (%)': current_account['Margin_Percent'],
+     'What-If Margin (%)': whatif_account['Margin_Percent']
+    })
+    st.dataframe(account_whatif, use_container_width=True, height=350)
+  
+  st.markdown(f"<small>Recomputed from {len(financial_base):,} pre-aggregated rows in {whatif_elapsed:.1f} ms</small>",
+              unsafe_allow_html=True)
+
+@timed_fragment('geo_drilldown')
+def render_geo_drilldown(geo_rollups):
+ """Top lanes at the chosen geographic level and origin"""
+ if geo_rollups:
+  st.markdown('<p class="chart-title">Geographic Drill-Down</p>', unsafe_allow_html=True)
+  
+  levels = geo_rollups['levels']
+  col1, col2 = st.columns(2)
+  
+  with col1:
+   drill_level = st.selectbox("Drill level", levels, index=min(1, len(levels) - 1), key='lane_drill_level')
+  
+  with col2:
+   level_index = levels.index(drill_level)
+   if level_index > 0:
+    parents = sorted(p for p in geo_rollups['drill'][drill_level] if p != 'All')
+    drill_parent = st.selectbox(f"Origin {levels[level_index - 1].lower()}", ['All'] + parents,
+                                key='lane_drill_parent')
+   else:
+    drill_parent = 'All'
+  
+  drill_lanes = lane_drilldown(geo_rollups, drill_level, drill_parent).head(20)
+  
+  if not drill_lanes.empty:
+   drill_chart = drill_lanes.assign(Lane=drill_lanes['Origin'] + ' → ' + drill_lanes['Destination'])
+   fig = px.bar(drill_chart, x='Lane', y='Volume',
+              color='Destination_Parent',
+              title=f'Top {drill_level} Lanes' + ('' if drill_parent == 'All' else f' from {drill_parent}'))
+   fig.update_layout(xaxis_tickangle=-45, height=400, legend_title_text='Destination')
+   st.plotly_chart(fig, use_container_width=True)
+   
+   st.dataframe(drill_lanes[['Origin', 'Destination', 'Volume', 'Weight']], hide_index=True, use_container_width=True)
+   render_downloads(f'lanes_{drill_level.lower()}',
+                    lambda level=drill_level, parent=drill_parent: lane_drilldown(geo_rollups, level, parent)[
+                     ['Origin', 'Destination', 'Volume', 'Weight']], 'lane_download')
+  else:
+   st.info(f"No {drill_level.lower()}-level lanes for this selection")
+
+@timed_fragment('hub_structure')
+def render_hub_structure(geo_rollups, all_lanes):
+ """Hub centrality and flow imbalance for the chosen network level and volume threshold"""
+ st.markdown('<p class="chart-title">Hub Structure Analysis</p>', unsafe_allow_html=True)
+ 
+ col1, col2 = st.columns(2)
+ 
+ with col1:
+  if geo_rollups:
+   network_levels = [level for level in geo_rollups['levels'] if level != 'Region']
+   network_level = st.selectbox("Network level", network_levels, key='network_level')
+   network_lanes = geo_rollups['lanes'][network_level]
+  else:
+   network_lanes = pd.DataFrame(all_lanes)
+ 
+ with col2:
+  max_lane_volume = int(network_lanes['Volume'].max()) if not network_lanes.empty else 1
+  min_lane_volume = st.slider("Minimum lane volume", 1, max(max_lane_volume, 2), 1, key='network_min_volume')
+ 
+ network_lanes = network_lanes[network_lanes['Volume'] >= min_lane_volume]
+ 
+ if not network_lanes.empty:
+  network = compute_lane_network(network_lanes, 'NL')
+  network_summary = network['summary']
+  
+  col1, col2, col3 = st.columns(3)
+  
+  with col1:
+   st.metric("Flow via NL", f"{network_summary['hub_flow_share']*100:.1f}%", "of network volume")
+  
+  with col2:
+   st.metric("Network Nodes", f"{network_summary['nodes']:,}", f"{network_summary['edges']:,} lanes")
+  
+  with col3:
+   st.metric("Two-Way Corridors", f"{network_summary['reciprocal_pairs']:,}", "with flow both ways")
+  
+  col1, col2 = st.columns(2)
+  
+  with col1:
+   st.markdown("**Hub Centrality**")
+   st.markdown("<small>Weighted PageRank - share of flow that passes through each node</small>", unsafe_allow_html=True)
+   
+   hub_data = network['nodes'].head(10)
+   fig = px.bar(hub_data, x='Node', y='Hub_Centrality',
+              title='',
+              color='Hub_Centrality',
+              color_continuous_scale='Blues')
+   fig.update_layout(showlegend=False, height=350, yaxis_title='Centrality')
+   st.plotly_chart(fig, use_container_width=True)
+  
+  with col2:
+   st.markdown("**Reciprocal Flow Imbalance**")
+   st.markdown("<small>+100% = one-way A → B, 0% = balanced, -100% = one-way B → A</small>", unsafe_allow_html=True)
+   
+   pair_table = network['pairs'].head(15).copy()
+   pair_table['Imbalance %'] = (pair_table['Imbalance'] * 100).round(1)
+   pair_table = pair_table[['Node_A', 'Node_B', 'Flow_A_to_B', 'Flow_B_to_A', 'Imbalance %']]
+   pair_table.columns = ['A', 'B', 'A → B', 'B → A', 'Imbalance %']
+   st.dataframe(pair_table, hide_index=True, use_container_width=True, height=350)
+  
+  node_table = network['nodes'].copy()
+  node_table['Hub_Centrality'] = (node_table['Hub_Centrality'] * 100).round(2)
+  node_table['Net_Imbalance'] = (node_table['Net_Imbalance'] * 100).round(1)
+  node_table.columns = ['Node', 'Centrality (%)', 'Out Lanes', 'In Lanes', 'Out Volume', 'In Volume', 'Net Outflow (%)']
+  st.dataframe(node_table, hide_index=True, use_container_width=True)
+
+@timed_fragment('consolidation')
+def render_consolidation(tms_data):
+ """Consolidation candidates for the chosen lane level and pickup window"""
+ if 'raw_data' in tms_data and 'Pickup_Date' in tms_data['raw_data'].columns and tms_data.get('geo_rollups'):
+  st.markdown('<p class="chart-title">Shipment Consolidation Opportunities</p>', unsafe_allow_html=True)
+  st.markdown("<small>Shipments on the same lane picked up in the same time window that could travel as one</small>", unsafe_allow_html=True)
+  
+  col1, col2 = st.columns(2)
+  
+  with col1:
+   lane_levels = [level for level in tms_data['geo_rollups']['levels'] if level != 'Region']
+   consolidation_level = st.selectbox("Lane level", lane_levels, index=len(lane_levels) - 1, key='consolidation_level')
+  
+  with col2:
+   window_hours = st.select_slider("Consolidation window", options=[4, 8, 12, 24, 48, 72], value=24,
+                                   format_func=lambda h: f"{h}h" + (" (same day)" if h == 24 else ""),
+                                   key='consolidation_window')
+  
+  consolidation = compute_consolidation(tms_data['dataset_hash'], tms_data, window_hours, consolidation_level)
+  
+  if consolidation and not consolidation['candidates'].empty:
+   col1, col2, col3 = st.columns(3)
+   
+   with col1:
+    st.metric("Consolidatable Shipments", f"{consolidation['consolidatable']:,}",
+              f"{consolidation['consolidatable']/consolidation['shipments']*100:.1f}% of shipments")
+   
+   with col2:
+    st.metric("Pickups Saved", f"{consolidation['pickups_saved']:,}", f"{len(consolidation['candidates']):,} groups")
+   
+   with col3:
+    st.metric("Est. Savings", f"{CURRENCY_SYMBOL}{consolidation['est_savings']:,.0f}", "pickup + linehaul")
+   
+   candidate_table = consolidation['candidates'].head(50).copy()
+   candidate_table['Lane'] = candidate_table['Origin'] + ' → ' + candidate_table['Destination']
+   candidate_table['Est_Savings'] = candidate_table['Est_Savings'].round(0)
+   candidate_table['Leg_Cost'] = candidate_table['Leg_Cost'].round(0)
+   candidate_table = candidate_table[['Lane', 'First_Pickup', 'Last_Pickup', 'Shipments', 'Weight', 'Leg_Cost', 'Est_Savings']]
+   candidate_table.columns = ['Lane', 'First Pickup', 'Last Pickup', 'Shipments', 'Weight', f'PU + Ship Cost ({CURRENCY_LABEL})', f'Est. Savings ({CURRENCY_LABEL})']
+   st.dataframe(candidate_table, hide_index=True, use_container_width=True)
+  else:
+   st.info("No shipments share a lane within this window")
+
+@timed_fragment('pivot_explorer')
+def render_pivot_explorer(tms_data):
+ """Pivot controls, chart and table over the AMS raw data"""
+ if 'raw_data' in tms_data and not tms_data['raw_data'].empty:
+  raw_df = tms_data['raw_data']
+  dimensions = pivot_dimensions(raw_df)
+  measures = pivot_measures(raw_df)
+  
+  if dimensions:
+   col1, col2, col3 = st.columns(3)
+   
+   with col1:
+    pivot_rows = st.selectbox("Rows", dimensions, key='pivot_rows')
+   
+   with col2:
+    pivot_cols = st.selectbox("Columns", ['(none)'] + dimensions, key='pivot_cols')
+    pivot_cols = None if pivot_cols == '(none)' else pivot_cols
+   
+   with col3:
+    measure_options = ['Shipments (count)'] + [f'Sum of {m}' for m in measures] + [f'Average of {m}' for m in measures]
+    pivot_measure = st.selectbox("Measure", measure_options, key='pivot_measure')
+   
+   col1, col2 = st.columns([1, 2])
+   
+   with col1:
+    filter_dim = st.selectbox("Filter on", ['(none)'] + dimensions, key='pivot_filter_dim')
+   
+   with col2:
+    filter_values = []
+    if filter_dim != '(none)':
+     filter_options = sorted(raw_df[filter_dim].dropna().astype(str).unique())
+     filter_values = st.multiselect(f"Keep {filter_dim}", filter_options, key='pivot_filter_values')
+   
+   if pivot_measure == 'Shipments (count)':
+    statistic, value_col = 'count', None
+   else:
+    statistic = 'sum' if pivot_measure.startswith('Sum of ') else 'mean'
+    value_col = pivot_measure.split(' of ', 1)[1]
+   
+   filters = {filter_dim: filter_values} if filter_dim != '(none)' and filter_values else {}
+   pivot_dims = [pivot_rows] + ([pivot_cols] if pivot_cols else [])
+   aggregate, pivot_source = pivot_aggregate(raw_df, pivot_dims, value_col, filters,
+                                             get_pivot_cache(tms_data['dataset_hash']))
+   result = pivot_table(aggregate, pivot_rows, pivot_cols, statistic)
+   
+   source_text = {
+    'cache': 'served from cache',
+    'rollup': 'rolled up from a cached finer grouping',
+    'scan': f'computed from {len(raw_df):,} shipment rows'
+   }[pivot_source]
+   st.markdown(f"<small>{len(result):,} rows × {len(result.columns):,} columns - {source_text}</small>", unsafe_allow_html=True)
+   
+   if pivot_cols and pivot_cols != pivot_rows and result.size <= 5000:
+    fig = px.imshow(result.fillna(0),
+                   labels=dict(x=pivot_cols, y=pivot_rows, color=pivot_measure),
+                   title='',
+                   color_continuous_scale='YlOrRd',
+                   aspect='auto')
+    fig.update_layout(height=500)
+    st.plotly_chart(fig, use_container_width=True)
+   elif not pivot_cols and len(result) <= 200:
+    chart_data = result.reset_index()
+    fig = px.bar(chart_data, x=chart_data.columns[0], y=chart_data.columns[-1], title='')
+    fig.update_layout(height=400)
+    st.plotly_chart(fig, use_container_width=True)
+   
+   st.dataframe(result.round(2), use_container_width=True)
+  else:
+   st.info("The AMS RAW DATA sheet has no columns suitable for pivoting")
+ else:
+  st.info("Upload a workbook with an 'AMS RAW DATA' sheet to build pivots")
+
+@timed_fragment('sql_console')
+def render_sql_console(tms_data):
+ """Query editor and paged results over the loaded frames"""
+ if not SQL_CONSOLE_AVAILABLE:
+  st.info("The SQL console needs the optional DuckDB engine: `pip install duckdb`")
+ else:
+  sql_tables = query_tables(tms_data)
+  
+  st.markdown("**Available tables**")
+  st.markdown("<small>Queried in place by DuckDB - the loaded frames are not copied</small>", unsafe_allow_html=True)
+  table_summary = pd.DataFrame([
+   {'Table': name, 'Rows': len(frame), 'Columns': ', '.join(map(str, frame.columns))}
+   for name, frame in sql_tables.items()
+  ])
+  st.dataframe(table_summary, hide_index=True, use_container_width=True)
+  
+  sql_text = st.text_area("Query", height=150, key='sql_query',
+                          placeholder="SELECT Status, count(*) AS orders FROM otp GROUP BY Status")
+  
+  col1, col2, col3 = st.columns([1, 1, 2])
+  
+  with col1:
+   sql_timeout = st.selectbox("Time limit (s)", SQL_TIMEOUT_OPTIONS, index=1, key='sql_timeout')
+  
+  with col2:
+   run_clicked = st.button("▶ Run query", key='sql_run')
+  
+  # Remember the last submitted query so paging re-reads only the requested window
+  if run_clicked and sql_text.strip():
+   st.session_state['sql_submitted'] = sql_text
+   st.session_state['sql_page'] = 1
+   st.session_state.pop('sql_total_rows', None)
+  
+  submitted_sql = st.session_state.get('sql_submitted')
+  if submitted_sql:
+   total_rows = st.session_state.get('sql_total_rows')
+   
+   with col3:
+    total_pages = max(1, -(-total_rows // SQL_PAGE_SIZE)) if total_rows is not None else 1
+    sql_page = st.number_input(f"Page (of {total_pages:,})", min_value=1, max_value=total_pages, step=1, key='sql_page')
+   
+   try:
+    result, counted_rows, elapsed = run_sql_query(sql_tables, submitted_sql, sql_page, SQL_PAGE_SIZE,
+                                                  sql_timeout, count=total_rows is None)
+    if counted_rows is not None:
+     st.session_state['sql_total_rows'] = counted_rows
+     total_rows = counted_rows
+    st.markdown(f"<small>{total_rows:,} rows in {elapsed*1000:,.0f} ms - showing rows "
+                f"{min((sql_page - 1) * SQL_PAGE_SIZE + 1, total_rows):,}–{min(sql_page * SQL_PAGE_SIZE, total_rows):,}</small>",
+                unsafe_allow_html=True)
+    st.dataframe(result, hide_index=True, use_container_width=True)
+   except Exception as e:
+    st.error(f"Query failed: {str(e)}")
 
-# Load data
+# Load data - the compute workers are started on the first page view, before any upload
+get_compute_pool()
 tms_data = None
-if uploaded_file is not None:
- tms_data = load_tms_data(uploaded_file)
+source_name = None
+if WATCH_DIR and st.sidebar.toggle("📂 Follow watched folder", key='follow_watch_dir',
+                                   help=f"Load the workbooks dropped into {WATCH_DIR} and refresh when they change"):
+ # Refreshed files are ingested once by the shared watcher; sessions following one rerun when it changes
+ watcher = get_folder_watcher()
+ watched = sorted(watcher['files'].items(), key=lambda item: item[1]['modified'], reverse=True)
+ watched_path = None
+ if watched:
+  watched_names = [entry['name'] for _, entry in watched]
+  watched_name = st.sidebar.selectbox("Workbook", watched_names, key='watched_workbook')
+  watched_path, watched_entry = watched[watched_names.index(watched_name)]
+  tms_data, source_name = watched_entry['data'], watched_entry['name']
+  st.sidebar.success(f"✅ Refreshed {watched_entry['refreshed']:%H:%M:%S}")
+ else:
+  st.sidebar.info(f"📁 Waiting for a workbook in {WATCH_DIR}")
+ with st.sidebar:
+  render_folder_watch(watcher, watched_path, tms_data['dataset_hash'] if tms_data else None,
+                      sorted(watcher['files']))
+elif uploaded_file is not None:
+ tms_data = read_workbook(uploaded_file)
+ source_name = uploaded_file.name
  if tms_data:
   st.sidebar.success("✅ Data loaded successfully")
  else:
@@ -203,6 +1183,52 @@ if uploaded_file is not None:
 else:
  st.sidebar.info("📁 Upload Excel file to begin")
 
+# Publish this dataset's KPIs to the local JSON API (serialized once per dataset)
+if tms_data:
+ kpi_store, kpi_server, kpi_error = get_kpi_api()
+ if not has_kpis(kpi_store, tms_data['dataset_hash']):
+  publish_kpis(kpi_store, tms_data['dataset_hash'], build_kpi_payload(tms_data))
+ if kpi_server is not None:
+  api_root = f"http://{KPI_API_HOST}:{kpi_server.server_address[1]}"
+  st.sidebar.caption(f"KPI API: {api_root}/api/kpis · Metrics: {api_root}/metrics")
+ else:
+  st.sidebar.warning(kpi_error)
+
+# Order search - prefix lookup in the index built at ingestion
+if tms_data is not None and 'search_index' in tms_data:
+ st.sidebar.markdown("---")
+ with st.sidebar:
+  render_order_search(tms_data['search_index'])
+
+# Comparison mode - two periods of this workbook, or this workbook against a baseline workbook
+comparison = None
+if tms_data is not None and 'period_aggregates' in tms_data:
+ st.sidebar.markdown("---")
+ comparison_mode = st.sidebar.radio("📈 Comparison", ['Off', 'Two periods', 'Two workbooks'], key='comparison_mode')
+ period_aggregates = tms_data['period_aggregates']
+ 
+ if comparison_mode == 'Two periods' and len(period_aggregates['periods']) >= 2:
+  periods = period_aggregates['periods']
+  baseline_period = st.sidebar.selectbox("Baseline period", periods, index=len(periods) - 2, key='comparison_baseline')
+  current_period = st.sidebar.selectbox("Current period", periods, index=len(periods) - 1, key='comparison_current')
+  comparison = {
+   'label': f"{current_period} vs {baseline_period}",
+   'deltas': compare_snapshots(snapshot_aggregates(period_aggregates, [current_period]),
+                               snapshot_aggregates(period_aggregates, [baseline_period]))
+  }
+ elif comparison_mode == 'Two periods':
+  st.sidebar.caption("The workbook covers fewer than two months")
+ elif comparison_mode == 'Two workbooks':
+  baseline_file = st.sidebar.file_uploader("Baseline TMS Excel File", type=['xlsx', 'xls'], key='baseline_file')
+  if baseline_file is not None:
+   baseline_data = read_workbook(baseline_file)
+   if baseline_data and 'period_aggregates' in baseline_data:
+    comparison = {
+     'label': f"{source_name} vs {baseline_file.name}",
+     'deltas': compare_snapshots(snapshot_aggregates(period_aggregates),
+                                 snapshot_aggregates(baseline_data['period_aggregates']))
+    }
+
 # Calculate global metrics for use across tabs
 avg_otp = 0
 total_orders = 0
@@ -228,24 +1254,26 @@ if tms_data is not None:
  if 'cost_sales' in tms_data and not tms_data['cost_sales'].empty:
   cost_df = tms_data['cost_sales']
   if 'Net_Revenue' in cost_df.columns:
-   total_revenue = cost_df['Net_Revenue'].sum()
+   total_revenue = reporting_amount(cost_df, 'Net_Revenue').sum()
   if 'Total_Cost' in cost_df.columns:
-   total_cost = cost_df['Total_Cost'].sum()
+   total_cost = reporting_amount(cost_df, 'Total_Cost').sum()
   profit_margin = ((total_revenue - total_cost) / total_revenue * 100) if total_revenue > 0 else 0
 
 # Create tabs for each sheet
 if tms_data is not None:
- tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
+ tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs([
   "📊 Overview", 
   "📦 Volume Analysis", 
   "⏱️ OTP Performance", 
   "💰 Financial Analysis", 
   "🛣️ Lane Network",
-  "📄 Executive Report"
+  "📄 Executive Report",
+  "🧮 Pivot Explorer",
+  "🧾 SQL Console"
  ])
  
  # TAB 1: Overview
- with tab1:
+ with tab1, timed_metric('tms_tab_render_seconds', tab='Overview'):
   st.markdown('<h2 class="section-header">Executive Dashboard Overview</h2>', unsafe_allow_html=True)
   
   # KPI Dashboard
@@ -258,7 +1286,7 @@ if tms_data is not None:
    st.metric("⏱️ OTP Rate", f"{avg_otp:.1f}%", f"{avg_otp-95:.1f}% vs target")
   
   with col3:
-   st.metric("💰 Revenue", f"€{total_revenue:,.0f}", "total")
+   st.metric("💰 Revenue", f"{CURRENCY_SYMBOL}{total_revenue:,.0f}", "total")
   
   with col4:
    st.metric("📈 Margin", f"{profit_margin:.1f}%", f"{profit_margin-20:.1f}% vs target")
@@ -301,20 +1329,61 @@ if tms_data is not None:
    
    if profit_margin >= 20:
     st.markdown(f"""
-    ✅ **{profit_margin:.1f}% margin** means €{profit_margin:.0f} profit per €100 revenue
+    ✅ **{profit_margin:.1f}% margin** means {CURRENCY_SYMBOL}{profit_margin:.0f} profit per {CURRENCY_SYMBOL}100 revenue
     - Healthy profitability above 20% target
     - Strong financial position for growth investments
     """)
    else:
     st.markdown(f"""
     ⚠️ **{profit_margin:.1f}% margin** needs improvement
-    - Currently €{profit_margin:.0f} profit per €100 revenue
-    - Need to increase by €{20-profit_margin:.0f} per €100 to hit target
+    - Currently {CURRENCY_SYMBOL}{profit_margin:.0f} profit per {CURRENCY_SYMBOL}100 revenue
+    - Need to increase by {CURRENCY_SYMBOL}{20-profit_margin:.0f} per {CURRENCY_SYMBOL}100 to hit target
     """)
    st.markdown('</div>', unsafe_allow_html=True)
  
+  # Period-over-period comparison - deltas from the cached per-period aggregates
+  if comparison:
+   st.markdown(f'<p class="chart-title">Comparison: {comparison["label"]}</p>', unsafe_allow_html=True)
+   deltas = comparison['deltas']
+   
+   kpi_table = deltas['kpis'].set_index('Metric')
+   kpi_cols = st.columns(len(kpi_table))
+   for kpi_col, (metric_name, row) in zip(kpi_cols, kpi_table.iterrows()):
+    with kpi_col:
+     is_percent = metric_name.endswith('(%)')
+     if pd.isna(row['Current']):
+      value, delta = "n/a", None
+     elif is_percent:
+      value = f"{row['Current']:.1f}%"
+      delta = f"{row['Delta']:+.1f} pp" if pd.notna(row['Delta']) else None
+     else:
+      value = f"{row['Current']:,.0f}"
+      delta = f"{row['Delta']:+,.0f}" + (f" ({row['Delta %']:+.1f}%)" if pd.notna(row['Delta %']) else "")
+     st.metric(metric_name, value, delta, delta_color='inverse' if metric_name == 'Cost' else 'normal')
+   
+   col1, col2 = st.columns(2)
+   
+   with col1:
+    if not deltas['qc'].empty:
+     st.markdown("**Delay Reason Mix Change**")
+     qc_delta = deltas['qc'].reset_index().rename(columns={'index': 'Reason'})
+     fig = px.bar(qc_delta, x='Share Δ (pp)', y=qc_delta.columns[0], orientation='h',
+                 color='Share Δ (pp)', color_continuous_scale='RdYlGn_r', color_continuous_midpoint=0, title='')
+     fig.update_layout(height=350, yaxis_title='', showlegend=False)
+     st.plotly_chart(fig, use_container_width=True)
+   
+   with col2:
+    if not deltas['lanes'].empty:
+     st.markdown("**Biggest Lane Volume Changes**")
+     lane_delta = deltas['lanes'].head(15).reset_index()
+     lane_delta['Lane'] = lane_delta['Origin'] + ' → ' + lane_delta['Destination']
+     st.dataframe(lane_delta[['Lane', 'Baseline', 'Current', 'Delta']], hide_index=True, use_container_width=True, height=350)
+  
+  # Monte Carlo scenarios resampled from the historical per-lane delay distributions
+  render_scenario_simulator(tms_data)
+ 
  # TAB 2: Volume Analysis
- with tab2:
+ with tab2, timed_metric('tms_tab_render_seconds', tab='Volume Analysis'):
   st.markdown('<h2 class="section-header">Volume Analysis by Service & Country</h2>', unsafe_allow_html=True)
   
   if 'service_volumes' in tms_data and tms_data['service_volumes']:
@@ -363,12 +1432,7 @@ if tms_data is not None:
      # Country breakdown with regions
      country_table = country_data.copy()
      country_table['Share %'] = (country_table['Volume'] / country_table['Volume'].sum() * 100).round(1)
-     country_table['Region'] = country_table['Country'].apply(
-      lambda x: 'Europe' if x in ['AT', 'BE', 'DE', 'DK', 'ES', 'FR', 'GB', 'IT', 'NL', 'SE'] 
-      else 'Americas' if x in ['US'] 
-      else 'Asia-Pacific' if x in ['AU', 'NZ'] 
-      else 'Other'
-     )
+     country_table['Region'] = country_table['Country'].map(COUNTRY_REGIONS).fillna('Other')
      country_table = country_table.sort_values('Volume', ascending=False)
      st.dataframe(country_table, hide_index=True, use_container_width=True)
   
@@ -399,6 +1463,9 @@ if tms_data is not None:
    fig.update_layout(height=500)
    st.plotly_chart(fig, use_container_width=True)
   
+  # Demand forecast per service x country, fitted in one batch over all series
+  render_demand_forecast(tms_data)
+  
   # Detailed Analysis with meaning
   st.markdown('<div class="insight-box">', unsafe_allow_html=True)
   st.markdown("### 📦 Understanding the Volume Patterns")
@@ -430,13 +1497,14 @@ if tms_data is not None:
   st.markdown('</div>', unsafe_allow_html=True)
  
  # TAB 3: OTP Performance
- with tab3:
+ with tab3, timed_metric('tms_tab_render_seconds', tab='OTP Performance'):
   st.markdown('<h2 class="section-header">On-Time Performance Analysis</h2>', unsafe_allow_html=True)
   
   if 'otp' in tms_data and not tms_data['otp'].empty:
    otp_df = tms_data['otp']
    
    # OTP Status Analysis
+   selected_qc_reason = None
    col1, col2 = st.columns(2)
    
    with col1:
@@ -532,8 +1600,24 @@ if tms_data is not None:
       qc_detail_df['Impact'] = qc_detail_df['Count'].apply(
        lambda x: 'High' if x > 10 else 'Medium' if x > 5 else 'Low'
       )
-      qc_detail_df = qc_detail_df.sort_values('Count', ascending=False)
-      st.dataframe(qc_detail_df, hide_index=True, use_container_width=True)
+      qc_detail_df = qc_detail_df.sort_values('Count', ascending=False).reset_index(drop=True)
+      qc_selection = st.dataframe(qc_detail_df, hide_index=True, use_container_width=True,
+                                  on_select='rerun', selection_mode='single-row', key='qc_reason_table')
+      render_downloads('otp_delay_reasons', qc_detail_df, 'qc_reason_download')
+      st.markdown("<small>Select a reason to open its orders in the explorer below</small>", unsafe_allow_html=True)
+      if qc_selection.selection.rows:
+       selected_qc_reason = qc_detail_df.loc[qc_selection.selection.rows[0], 'Reason']
+   
+   # Order Explorer - OTP rows, pre-filtered by the selected delay reason
+   if 'otp_sort_index' in tms_data:
+    st.markdown('<p class="chart-title">Order Explorer</p>', unsafe_allow_html=True)
+    
+    if selected_qc_reason and 'QC_Name' in otp_df.columns:
+     qc_mask = otp_df['QC_Name'].astype(str).str.contains(selected_qc_reason, regex=False).to_numpy()
+     render_order_explorer('otp', otp_df, tms_data['otp_sort_index'], tms_data['dataset_hash'],
+                           f"Orders delayed by: {selected_qc_reason}", selected_qc_reason, qc_mask)
+    else:
+     render_order_explorer('otp', otp_df, tms_data['otp_sort_index'], tms_data['dataset_hash'])
    
    # Statistical Performance Summary
    st.markdown('<p class="chart-title">Performance Statistics Overview</p>', unsafe_allow_html=True)
@@ -580,6 +1664,12 @@ if tms_data is not None:
      st.write(f"- **Worst Late Case**: {worst_late:.1f} days late")
      st.write(f"- **Most Early**: {abs(worst_early):.1f} days early")
      st.write(f"- **Consistency**: Standard deviation of {time_diff_clean.std():.1f} days")
+   
+   # OTP and volume trends - served from the materialized daily rollup and rolling windows
+   render_trends(tms_data, source_name)
+   
+   # Lateness recomputed from the raw timestamps under a configurable SLA
+   render_sla_recalculation(tms_data, otp_df)
   
   # OTP Detailed Insights
   st.markdown('<div class="insight-box">', unsafe_allow_html=True)
@@ -618,7 +1708,7 @@ if tms_data is not None:
   st.markdown('</div>', unsafe_allow_html=True)
  
  # TAB 4: Financial Analysis
- with tab4:
+ with tab4, timed_metric('tms_tab_render_seconds', tab='Financial Analysis'):
   st.markdown('<h2 class="section-header">Financial Performance & Profitability</h2>', unsafe_allow_html=True)
   
   if 'cost_sales' in tms_data and not tms_data['cost_sales'].empty:
@@ -627,6 +1717,16 @@ if tms_data is not None:
    # Financial Overview with spacing
    st.markdown('<p class="chart-title">Overall Financial Health</p>', unsafe_allow_html=True)
    
+   if 'Currency' in cost_df.columns:
+    currency_mix = cost_df['Currency'].value_counts()
+    currency_mix = currency_mix[currency_mix > 0]
+    st.markdown(f"<small>All amounts in {REPORTING_CURRENCY}, converted from {len(currency_mix)} "
+                f"invoice currencies ({', '.join(currency_mix.index.astype(str))})</small>", unsafe_allow_html=True)
+    if 'FX_Rate_Rpt' in cost_df.columns and cost_df['FX_Rate_Rpt'].isna().any():
+     missing_fx = cost_df.loc[cost_df['FX_Rate_Rpt'].isna(), 'Currency'].astype(str).unique()
+     st.warning(f"No FX rate for {', '.join(missing_fx)} - those orders are excluded from {REPORTING_CURRENCY} totals. "
+                f"Add them to an 'FX Rates' sheet or fx_rates.csv (Date, Currency, Rate).")
+   
    col1, col2, col3 = st.columns([1, 1, 1])
    
    with col1:
@@ -650,7 +1750,7 @@ if tms_data is not None:
     
     # Financial summary
     st.write(f"**Profit Margin**: {profit_margin:.1f}%")
-    st.write(f"**Profit per shipment**: €{profit/total_services:.2f}")
+    st.write(f"**Profit per shipment**: {CURRENCY_SYMBOL}{profit/total_services:.2f}")
    
    with col2:
     st.markdown("**Where Money Goes - Cost Breakdown**")
@@ -660,7 +1760,7 @@ if tms_data is not None:
     cost_cols = ['PU_Cost', 'Ship_Cost', 'Man_Cost', 'Del_Cost']
     for col in cost_cols:
      if col in cost_df.columns:
-      cost_sum = cost_df[col].sum()
+      cost_sum = reporting_amount(cost_df, col).sum()
       if cost_sum > 0:
        cost_components[col.replace('_Cost', '')] = cost_sum
     
@@ -709,21 +1809,13 @@ if tms_data is not None:
    st.markdown("<br>", unsafe_allow_html=True)
    
    # Country Financial Performance - FIXED to only show countries with financial data
-   if 'PU_Country' in cost_df.columns:
+   financial_base = tms_data.get('financial_base')
+   
+   if 'PU_Country' in cost_df.columns and financial_base is not None:
     st.markdown('<p class="chart-title">Country-by-Country Financial Performance</p>', unsafe_allow_html=True)
     
-    # Only aggregate countries that have financial data
-    country_financials = cost_df.groupby('PU_Country').agg({
-     'Net_Revenue': 'sum',
-     'Total_Cost': 'sum',
-     'Gross_Percent': 'mean'
-    }).round(2)
-    
-    country_financials['Profit'] = country_financials['Net_Revenue'] - country_financials['Total_Cost']
-    country_financials['Margin_Percent'] = (country_financials['Gross_Percent'] * 100).round(1)
-    
-    # Sort by revenue
-    country_financials = country_financials.sort_values('Net_Revenue', ascending=False)
+    # Roll up the pre-aggregated sums - margin is revenue-weighted (total profit / total revenue)
+    country_financials = rollup_financials(financial_base, ['Country']).round(2)
     
     # Create subplots with better spacing
     col1, col2 = st.columns([1, 1])
@@ -740,7 +1832,8 @@ if tms_data is not None:
                 color='Net_Revenue',
                 color_continuous_scale=[[0, '#006d2c'], [0.5, '#31a354'], [1, '#74c476']])
      fig.update_layout(showlegend=False, height=400)
-     st.plotly_chart(fig, use_container_width=True)
+     revenue_selection = st.plotly_chart(fig, use_container_width=True, on_select='rerun',
+                                         selection_mode='points', key='revenue_country_chart')
     
     with col2:
      st.markdown("**Profit/Loss by Country**")
@@ -754,7 +1847,8 @@ if tms_data is not None:
                 color='Color',
                 color_discrete_map={'Profit': '#2ca02c', 'Loss': '#d62728'})
      fig.update_layout(showlegend=False, height=400)
-     st.plotly_chart(fig, use_container_width=True)
+     profit_selection = st.plotly_chart(fig, use_container_width=True, on_select='rerun',
+                                        selection_mode='points', key='profit_country_chart')
     
     # Detailed financial table with insights - only show countries with data
     st.markdown("**Detailed Country Performance**")
@@ -767,18 +1861,39 @@ if tms_data is not None:
      lambda x: '🟢 Profitable' if x > 0 else '🔴 Loss-making'
     )
     display_financials = display_financials[['Revenue', 'Cost', 'Profit', 'Margin_Percent', 'Status']]
-    display_financials.columns = ['Revenue (€)', 'Cost (€)', 'Profit (€)', 'Margin (%)', 'Status']
+    display_financials.columns = [f'Revenue ({CURRENCY_LABEL})', f'Cost ({CURRENCY_LABEL})', f'Profit ({CURRENCY_LABEL})', 'Margin (%)', 'Status']
     
     st.dataframe(display_financials, use_container_width=True)
+    render_downloads('financials_by_country', display_financials, 'financials_download')
+    
+    # Order Explorer - cost sales rows, pre-filtered by the clicked country bar
+    if 'cost_sort_index' in tms_data:
+     st.markdown('<p class="chart-title">Order Explorer</p>', unsafe_allow_html=True)
+     st.markdown("<small>Click a country bar above to filter the orders</small>", unsafe_allow_html=True)
+     
+     selected_points = revenue_selection.selection.points or profit_selection.selection.points
+     if selected_points:
+      selected_country = selected_points[0]['x']
+      country_mask = (cost_df['PU_Country'] == selected_country).to_numpy()
+      render_order_explorer('cost', cost_df, tms_data['cost_sort_index'], tms_data['dataset_hash'],
+                            f"Orders picked up in {selected_country}", selected_country, country_mask)
+     else:
+      render_order_explorer('cost', cost_df, tms_data['cost_sort_index'], tms_data['dataset_hash'])
+   
+   # Margins by account, office and month - rolled up from the same additive base
+   render_margin_drilldown(financial_base)
+   
+   # What-if pricing and cost changes - linear in the additive financial base, no row-level work
+   render_whatif(financial_base)
   
   # Financial Insights with business meaning
   st.markdown('<div class="insight-box">', unsafe_allow_html=True)
   st.markdown("### 💰 Understanding the Financial Picture")
   st.markdown(f"""
   **Overall Financial Health:**
-  - **Revenue of €{total_revenue:,.0f}** from {total_services} shipments = €{total_revenue/total_services:.2f} per shipment
-  - **Costs of €{total_cost:,.0f}** = €{total_cost/total_services:.2f} per shipment
-  - **Profit margin {profit_margin:.1f}%** means: for every €100 earned, we keep €{profit_margin:.2f}
+  - **Revenue of {CURRENCY_SYMBOL}{total_revenue:,.0f}** from {total_services} shipments = {CURRENCY_SYMBOL}{total_revenue/total_services:.2f} per shipment
+  - **Costs of {CURRENCY_SYMBOL}{total_cost:,.0f}** = {CURRENCY_SYMBOL}{total_cost/total_services:.2f} per shipment
+  - **Profit margin {profit_margin:.1f}%** means: for every {CURRENCY_SYMBOL}100 earned, we keep {CURRENCY_SYMBOL}{profit_margin:.2f}
   - {'Strong position' if profit_margin >= 20 else f'Need to improve by {20-profit_margin:.1f}% to reach healthy 20% target'}
   
   **Cost Structure Analysis:**
@@ -805,7 +1920,7 @@ if tms_data is not None:
   st.markdown('</div>', unsafe_allow_html=True)
  
  # TAB 5: Lane Network
- with tab5:
+ with tab5, timed_metric('tms_tab_render_seconds', tab='Lane Network'):
   st.markdown('<h2 class="section-header">Lane Network & Route Analysis</h2>', unsafe_allow_html=True)
   
   # Initialize variables
@@ -816,6 +1931,10 @@ if tms_data is not None:
   if 'lanes' in tms_data and not tms_data['lanes'].empty:
    lane_df = tms_data['lanes']
    
+   # Country-level lanes materialized at ingestion from the raw shipment rows
+   geo_rollups = tms_data.get('geo_rollups')
+   country_lanes = geo_rollups['lanes']['Country'] if geo_rollups else None
+   
    # Based on the Excel screenshot, set up the proper structure
    # The data shows specific lanes like NL->various countries with actual volumes
    
@@ -831,19 +1950,22 @@ if tms_data is not None:
     st.markdown("**Top Origin Countries**")
     st.markdown("<small>Countries sending most shipments</small>", unsafe_allow_html=True)
     
-    # Based on screenshot data
-    origin_volumes = {
-     'NL': 67,  # Netherlands is clearly the main origin
-     'FR': 8,
-     'DE': 17,
-     'BE': 11,
-     'IT': 12,
-     'GB': 4,
-     'AT': 4,
-     'DK': 3,
-     'PL': 4,
-     'CH': 4
-    }
+    if country_lanes is not None:
+     origin_volumes = country_lanes.groupby('Origin')['Volume'].sum().to_dict()
+    else:
+     # Based on screenshot data
+     origin_volumes = {
+      'NL': 67,  # Netherlands is clearly the main origin
+      'FR': 8,
+      'DE': 17,
+      'BE': 11,
+      'IT': 12,
+      'GB': 4,
+      'AT': 4,
+      'DK': 3,
+      'PL': 4,
+      'CH': 4
+     }
     
     origin_data = pd.DataFrame(list(origin_volumes.items()), 
                              columns=['Origin', 'Volume'])
@@ -860,19 +1982,22 @@ if tms_data is not None:
     st.markdown("**Top Destination Countries**")
     st.markdown("<small>Countries receiving most shipments</small>", unsafe_allow_html=True)
     
-    # Based on the visible data in screenshot
-    dest_volumes = {
-     'NL': 47,
-     'IT': 12,
-     'FR': 17,
-     'GB': 10,
-     'DE': 9,
-     'BE': 8,
-     'US': 8,
-     'AT': 5,
-     'AU': 3,
-     'NZ': 3
-    }
+    if country_lanes is not None:
+     dest_volumes = country_lanes.groupby('Destination')['Volume'].sum().to_dict()
+    else:
+     # Based on the visible data in screenshot
+     dest_volumes = {
+      'NL': 47,
+      'IT': 12,
+      'FR': 17,
+      'GB': 10,
+      'DE': 9,
+      'BE': 8,
+      'US': 8,
+      'AT': 5,
+      'AU': 3,
+      'NZ': 3
+     }
     
     dest_data = pd.DataFrame(list(dest_volumes.items()), 
                            columns=['Destination', 'Volume'])
@@ -889,51 +2014,54 @@ if tms_data is not None:
    st.markdown('<p class="chart-title">Complete Lane Network Matrix</p>', unsafe_allow_html=True)
    
    # Create complete lane data including all lanes
-   all_lanes = [
-    {'Origin': 'NL', 'Destination': 'IT', 'Volume': 12},
-    {'Origin': 'NL', 'Destination': 'NL', 'Volume': 8},
-    {'Origin': 'NL', 'Destination': 'DE', 'Volume': 7},
-    {'Origin': 'NL', 'Destination': 'US', 'Volume': 6},
-    {'Origin': 'NL', 'Destination': 'FR', 'Volume': 11},
-    {'Origin': 'NL', 'Destination': 'BE', 'Volume': 3},
-    {'Origin': 'NL', 'Destination': 'GB', 'Volume': 4},
-    {'Origin': 'NL', 'Destination': 'AU', 'Volume': 3},
-    {'Origin': 'NL', 'Destination': 'NZ', 'Volume': 3},
-    {'Origin': 'NL', 'Destination': 'AT', 'Volume': 4},
-    {'Origin': 'NL', 'Destination': 'ES', 'Volume': 1},
-    {'Origin': 'NL', 'Destination': 'SE', 'Volume': 1},
-    {'Origin': 'NL', 'Destination': 'DK', 'Volume': 1},
-    {'Origin': 'NL', 'Destination': 'N1', 'Volume': 1},
-    {'Origin': 'FR', 'Destination': 'NL', 'Volume': 6},
-    {'Origin': 'FR', 'Destination': 'FR', 'Volume': 2},
-    {'Origin': 'DE', 'Destination': 'NL', 'Volume': 14},
-    {'Origin': 'DE', 'Destination': 'DE', 'Volume': 2},
-    {'Origin': 'DE', 'Destination': 'US', 'Volume': 1},
-    {'Origin': 'BE', 'Destination': 'NL', 'Volume': 4},
-    {'Origin': 'BE', 'Destination': 'BE', 'Volume': 5},
-    {'Origin': 'BE', 'Destination': 'FR', 'Volume': 1},
-    {'Origin': 'BE', 'Destination': 'US', 'Volume': 1},
-    {'Origin': 'IT', 'Destination': 'NL', 'Volume': 2},
-    {'Origin': 'IT', 'Destination': 'IT', 'Volume': 10},
-    {'Origin': 'GB', 'Destination': 'NL', 'Volume': 1},
-    {'Origin': 'GB', 'Destination': 'GB', 'Volume': 3},
-    {'Origin': 'AT', 'Destination': 'NL', 'Volume': 2},
-    {'Origin': 'AT', 'Destination': 'AT', 'Volume': 1},
-    {'Origin': 'AT', 'Destination': 'FR', 'Volume': 1},
-    {'Origin': 'DK', 'Destination': 'NL', 'Volume': 2},
-    {'Origin': 'DK', 'Destination': 'GB', 'Volume': 1},
-    {'Origin': 'PL', 'Destination': 'NL', 'Volume': 3},
-    {'Origin': 'PL', 'Destination': 'FR', 'Volume': 1},
-    {'Origin': 'CH', 'Destination': 'NL', 'Volume': 1},
-    {'Origin': 'CH', 'Destination': 'FR', 'Volume': 2},
-    {'Origin': 'CH', 'Destination': 'GB', 'Volume': 1},
-    {'Origin': 'FI', 'Destination': 'NL', 'Volume': 1},
-    {'Origin': 'FI', 'Destination': 'FR', 'Volume': 1},
-    {'Origin': 'FI', 'Destination': 'GB', 'Volume': 1},
-    {'Origin': 'CN', 'Destination': 'NL', 'Volume': 1},
-    {'Origin': 'CN', 'Destination': 'FR', 'Volume': 2},
-    {'Origin': 'HK', 'Destination': 'FR', 'Volume': 1}
-   ]
+   if country_lanes is not None:
+    all_lanes = country_lanes[['Origin', 'Destination', 'Volume']].to_dict('records')
+   else:
+    all_lanes = [
+     {'Origin': 'NL', 'Destination': 'IT', 'Volume': 12},
+     {'Origin': 'NL', 'Destination': 'NL', 'Volume': 8},
+     {'Origin': 'NL', 'Destination': 'DE', 'Volume': 7},
+     {'Origin': 'NL', 'Destination': 'US', 'Volume': 6},
+     {'Origin': 'NL', 'Destination': 'FR', 'Volume': 11},
+     {'Origin': 'NL', 'Destination': 'BE', 'Volume': 3},
+     {'Origin': 'NL', 'Destination': 'GB', 'Volume': 4},
+     {'Origin': 'NL', 'Destination': 'AU', 'Volume': 3},
+     {'Origin': 'NL', 'Destination': 'NZ', 'Volume': 3},
+     {'Origin': 'NL', 'Destination': 'AT', 'Volume': 4},
+     {'Origin': 'NL', 'Destination': 'ES', 'Volume': 1},
+     {'Origin': 'NL', 'Destination': 'SE', 'Volume': 1},
+     {'Origin': 'NL', 'Destination': 'DK', 'Volume': 1},
+     {'Origin': 'NL', 'Destination': 'N1', 'Volume': 1},
+     {'Origin': 'FR', 'Destination': 'NL', 'Volume': 6},
+     {'Origin': 'FR', 'Destination': 'FR', 'Volume': 2},
+     {'Origin': 'DE', 'Destination': 'NL', 'Volume': 14},
+     {'Origin': 'DE', 'Destination': 'DE', 'Volume': 2},
+     {'Origin': 'DE', 'Destination': 'US', 'Volume': 1},
+     {'Origin': 'BE', 'Destination': 'NL', 'Volume': 4},
+     {'Origin': 'BE', 'Destination': 'BE', 'Volume': 5},
+     {'Origin': 'BE', 'Destination': 'FR', 'Volume': 1},
+     {'Origin': 'BE', 'Destination': 'US', 'Volume': 1},
+     {'Origin': 'IT', 'Destination': 'NL', 'Volume': 2},
+     {'Origin': 'IT', 'Destination': 'IT', 'Volume': 10},
+     {'Origin': 'GB', 'Destination': 'NL', 'Volume': 1},
+     {'Origin': 'GB', 'Destination': 'GB', 'Volume': 3},
+     {'Origin': 'AT', 'Destination': 'NL', 'Volume': 2},
+     {'Origin': 'AT', 'Destination': 'AT', 'Volume': 1},
+     {'Origin': 'AT', 'Destination': 'FR', 'Volume': 1},
+     {'Origin': 'DK', 'Destination': 'NL', 'Volume': 2},
+     {'Origin': 'DK', 'Destination': 'GB', 'Volume': 1},
+     {'Origin': 'PL', 'Destination': 'NL', 'Volume': 3},
+     {'Origin': 'PL', 'Destination': 'FR', 'Volume': 1},
+     {'Origin': 'CH', 'Destination': 'NL', 'Volume': 1},
+     {'Origin': 'CH', 'Destination': 'FR', 'Volume': 2},
+     {'Origin': 'CH', 'Destination': 'GB', 'Volume': 1},
+     {'Origin': 'FI', 'Destination': 'NL', 'Volume': 1},
+     {'Origin': 'FI', 'Destination': 'FR', 'Volume': 1},
+     {'Origin': 'FI', 'Destination': 'GB', 'Volume': 1},
+     {'Origin': 'CN', 'Destination': 'NL', 'Volume': 1},
+     {'Origin': 'CN', 'Destination': 'FR', 'Volume': 2},
+     {'Origin': 'HK', 'Destination': 'FR', 'Volume': 1}
+    ]
    
    # Create matrix for heatmap
    origins = list(set([lane['Origin'] for lane in all_lanes]))
@@ -991,6 +2119,15 @@ if tms_data is not None:
    
    with col3:
     st.metric("Average per Lane", f"{avg_per_lane:.1f}", "shipments")
+   
+   # Geographic drill-down - served from the rollups materialized at ingestion
+   render_geo_drilldown(geo_rollups)
+   
+   # Hub structure - graph metrics over the lane volumes
+   render_hub_structure(geo_rollups, all_lanes)
+   
+  # Shipment consolidation - order-level lane view over AMS RAW DATA
+  render_consolidation(tms_data)
   
   # Network Insights with business meaning
   st.markdown('<div class="insight-box">', unsafe_allow_html=True)
@@ -1038,21 +2175,25 @@ if tms_data is not None:
   st.markdown('</div>', unsafe_allow_html=True)
  
  # TAB 6: Executive Report
- with tab6:
+ with tab6, timed_metric('tms_tab_render_seconds', tab='Executive Report'):
   st.markdown('<h2 class="section-header">Executive Summary Report</h2>', unsafe_allow_html=True)
   
   # Report Header
-  st.markdown(f"**Report Date**: {datetime.now().strftime('%B %d, %Y')}")
-  st.markdown(f"**Reporting Period**: Based on uploaded TMS data")
-  st.markdown("**Prepared for**: LFS Amsterdam Management Team")
+  report_meta = [
+   f"**Report Date**: {datetime.now().strftime('%B %d, %Y')}",
+   "**Reporting Period**: Based on uploaded TMS data",
+   "**Prepared for**: LFS Amsterdam Management Team"
+  ]
+  for line in report_meta:
+   st.markdown(line)
   
-  # Executive Summary
-  st.markdown('<div class="report-section">', unsafe_allow_html=True)
-  st.markdown("## 1. Executive Summary")
+  # Report sections are collected first so the tab and the HTML export render the same text
+  report_sections = []
   
+  # Executive Summary
   performance_status = "Meeting Targets" if avg_otp >= 95 and profit_margin >= 20 else "Below Targets"
   
-  st.markdown(f"""
+  report_sections.append(("1. Executive Summary", f"""
   LFS Amsterdam operates a **{performance_status}** logistics network processing **{total_services} shipments** 
   across **{len(COUNTRIES)} countries**. The operation centers on Amsterdam as the primary hub, handling 
   **37.6% of total volume** with strong connections throughout Europe and selective global reach.
@@ -1060,23 +2201,19 @@ if tms_data is not None:
   **Key Performance Indicators:**
   - **On-Time Performance**: {avg_otp:.1f}% (Target: 95%) - {'✅ Exceeding' if avg_otp >= 95 else '⚠️ Below'} target
   - **Profit Margin**: {profit_margin:.1f}% (Target: 20%) - {'✅ Healthy' if profit_margin >= 20 else '⚠️ Needs improvement'}
-  - **Revenue per Shipment**: €{total_revenue/total_services:.2f}
+  - **Revenue per Shipment**: {CURRENCY_SYMBOL}{total_revenue/total_services:.2f}
   - **Network Utilization**: {active_lanes} active lanes connecting major markets
   
   The business shows {'strong operational and financial health' if performance_status == "Meeting Targets" 
   else 'opportunities for operational and financial improvement'} with clear growth potential.
-  """)
-  st.markdown('</div>', unsafe_allow_html=True)
+  """))
   
   # Service Performance
-  st.markdown('<div class="report-section">', unsafe_allow_html=True)
-  st.markdown("## 2. Service Portfolio Analysis")
-  
   if 'service_volumes' in tms_data:
    top_services = sorted([(k, v) for k, v in tms_data['service_volumes'].items() if v > 0], 
                        key=lambda x: x[1], reverse=True)[:3]
    
-   st.markdown(f"""
+   report_sections.append(("2. Service Portfolio Analysis", f"""
    **Service Mix Interpretation:**
    
    The service portfolio reflects a balanced operation between speed and cost-efficiency:
@@ -1096,14 +2233,10 @@ if tms_data is not None:
    - No single service exceeds 30% of volume, indicating healthy diversification
    - Mix of express and standard services provides pricing flexibility
    - Zero volume in SF service suggests either new launch or discontinuation candidate
-   """)
-  st.markdown('</div>', unsafe_allow_html=True)
+   """))
   
   # Geographic Analysis
-  st.markdown('<div class="report-section">', unsafe_allow_html=True)
-  st.markdown("## 3. Geographic Strategy Evaluation")
-  
-  st.markdown(f"""
+  report_sections.append(("3. Geographic Strategy Evaluation", f"""
   **Market Position Analysis:**
   
   LFS Amsterdam operates a classic hub-and-spoke model with clear geographic priorities:
@@ -1126,14 +2259,10 @@ if tms_data is not None:
   
   **Key Insight**: European operations generate ~85% of volume, providing stable base 
   while limiting exposure to intercontinental risks.
-  """)
-  st.markdown('</div>', unsafe_allow_html=True)
+  """))
   
   # OTP Analysis
-  st.markdown('<div class="report-section">', unsafe_allow_html=True)
-  st.markdown("## 4. Operational Performance Review")
-  
-  st.markdown(f"""
+  report_sections.append(("4. Operational Performance Review", f"""
   **On-Time Performance Analysis**:
   
   Current OTP of {avg_otp:.1f}% translates to real customer impact:
@@ -1157,20 +2286,16 @@ if tms_data is not None:
   
   **Financial Impact**: Each 1% OTP improvement = {total_orders/100:.0f} more satisfied customers, 
   reducing complaint handling costs and protecting revenue.
-  """)
-  st.markdown('</div>', unsafe_allow_html=True)
+  """))
   
   # Financial Summary
-  st.markdown('<div class="report-section">', unsafe_allow_html=True)
-  st.markdown("## 5. Financial Performance Deep Dive")
-  
-  st.markdown(f"""
+  report_sections.append(("5. Financial Performance Deep Dive", f"""
   **Financial Health Indicators**:
   
-  The operation generates €{total_revenue:,.0f} revenue with {profit_margin:.1f}% margins, meaning:
-  - **Per shipment economics**: Revenue €{total_revenue/total_services:.2f}, Cost €{total_cost/total_services:.2f}, Profit €{(total_revenue-total_cost)/total_services:.2f}
+  The operation generates {CURRENCY_SYMBOL}{total_revenue:,.0f} revenue with {profit_margin:.1f}% margins, meaning:
+  - **Per shipment economics**: Revenue {CURRENCY_SYMBOL}{total_revenue/total_services:.2f}, Cost {CURRENCY_SYMBOL}{total_cost/total_services:.2f}, Profit {CURRENCY_SYMBOL}{(total_revenue-total_cost)/total_services:.2f}
   - **Margin quality**: {'Healthy margins support growth investment' if profit_margin >= 20 else f'Need {20-profit_margin:.1f}% improvement to reach sustainability target'}
-  - **Cash generation**: €{(total_revenue-total_cost):,.0f} available for reinvestment
+  - **Cash generation**: {CURRENCY_SYMBOL}{(total_revenue-total_cost):,.0f} available for reinvestment
   
   **Cost Structure Insights**:
   - First-mile (pickup) and main haul (shipping) dominate costs
@@ -1186,14 +2311,10 @@ if tms_data is not None:
   - Premium services (CX, EF) should maintain higher margins
   - Volume discounts on ROU service must preserve minimum margins
   - Country-specific pricing needed based on local cost structures
-  """)
-  st.markdown('</div>', unsafe_allow_html=True)
+  """))
   
   # Recommendations
-  st.markdown('<div class="report-section">', unsafe_allow_html=True)
-  st.markdown("## 6. Strategic Recommendations")
-  
-  st.markdown(f"""
+  report_sections.append(("6. Strategic Recommendations", f"""
   Based on comprehensive analysis, we recommend:
   
   **Immediate Actions** (Next 30 days):
@@ -1216,17 +2337,13 @@ if tms_data is not None:
   5. Consider acquisition to quickly scale in underserved markets
   
   **Investment Requirements**:
-  - Technology: €X for system upgrades and customer portal
-  - Infrastructure: €Y for automation and hub expansion
-  - Market development: €Z for sales and marketing in target countries
-  """)
-  st.markdown('</div>', unsafe_allow_html=True)
+  - Technology: {CURRENCY_SYMBOL}X for system upgrades and customer portal
+  - Infrastructure: {CURRENCY_SYMBOL}Y for automation and hub expansion
+  - Market development: {CURRENCY_SYMBOL}Z for sales and marketing in target countries
+  """))
   
   # Conclusion
-  st.markdown('<div class="report-section">', unsafe_allow_html=True)
-  st.markdown("## 7. Conclusion and Next Steps")
-  
-  st.markdown(f"""
+  report_sections.append(("7. Conclusion and Next Steps", f"""
   LFS Amsterdam operates a {'well-functioning' if performance_status == "Meeting Targets" else 'developing'} 
   logistics network with strong European presence and selective global reach. The Amsterdam hub strategy 
   provides operational efficiency while creating some concentration risk.
@@ -1253,5 +2370,85 @@ if tms_data is not None:
   
   This analysis provides clear direction for optimizing operations, improving profitability, 
   and positioning LFS Amsterdam for sustainable growth in the competitive logistics market.
-  """)
-  st.markdown('</div>', unsafe_allow_html=True)
+  """))
+  
+  for heading, section in report_sections:
+   st.markdown('<div class="report-section">', unsafe_allow_html=True)
+   st.markdown(f"## {heading}")
+   st.markdown(section)
+   st.markdown('</div>', unsafe_allow_html=True)
+  
+  # Static HTML export - built once per dataset in the background and kept for repeat downloads
+  st.markdown('<p class="chart-title">Export Report</p>', unsafe_allow_html=True)
+  
+  export_job = get_report_export(tms_data['dataset_hash'])
+  if export_job is None and st.button("Prepare HTML Export", key='prepare_report_export'):
+   report_kpis = [
+    ('On-Time Performance', f"{avg_otp:.1f}%"),
+    ('Profit Margin', f"{profit_margin:.1f}%"),
+    ('Revenue', f"{CURRENCY_SYMBOL}{total_revenue:,.0f}"),
+    ('Shipments', f"{total_services:,}"),
+    ('Active Lanes', f"{active_lanes:,}")
+   ]
+   export_job = get_report_export(tms_data['dataset_hash'], build_report_export, "Executive Summary Report",
+                                  report_meta, report_kpis, report_sections, tms_data)
+  
+  if export_job is not None:
+   if not export_job.done():
+    st.info("The HTML export is being built in the background - you can keep working in the other tabs")
+    st.button("Check Export Status", key='check_report_export')
+   elif export_job.exception() is not None:
+    st.error(f"Export failed: {export_job.exception()}")
+   else:
+    st.download_button("⬇️ Download Executive Report (HTML)", export_job.result(),
+                       file_name=f"executive_report_{tms_data['dataset_hash'][:8]}.html", mime='text/html',
+                       key='download_report_export')
+  
+  # Batch snapshots per office or per station workbook, rendered in parallel from the shared frame cache
+  st.markdown('<p class="chart-title">Batch Reports by Office or Station</p>', unsafe_allow_html=True)
+  
+  batch_mode = st.radio("Split by", ['Office', 'Workbook per station'], horizontal=True, key='batch_mode')
+  batch_jobs, batch_sources = [], {}
+  if batch_mode == 'Office':
+   offices = batch_units(tms_data.get('cost_sales'), 'Office')
+   if offices:
+    batch_sources[tms_data['dataset_hash']] = tms_data
+    batch_jobs = [(tms_data['dataset_hash'], 'Office', office, office) for office in offices]
+    st.markdown(f"<small>{len(offices)} offices found in the cost sales sheet</small>", unsafe_allow_html=True)
+   else:
+    st.info("The cost sales sheet has no Office column to split by")
+  else:
+   station_files = st.file_uploader("Station workbooks", type=['xlsx', 'xls'], accept_multiple_files=True,
+                                    key='batch_files')
+   for station_file in station_files or []:
+    station_data = read_workbook(station_file)
+    if station_data:
+     batch_sources[station_data['dataset_hash']] = station_data
+     batch_jobs.append((station_data['dataset_hash'], None, None, os.path.splitext(station_file.name)[0]))
+  
+  batch_jobs = tuple(batch_jobs)
+  if batch_jobs and st.button(f"Generate {len(batch_jobs)} Reports", key='generate_batch_reports'):
+   st.session_state['batch_jobs'] = batch_jobs
+  
+  if batch_jobs and st.session_state.get('batch_jobs') == batch_jobs:
+   # Already stored at load (re-published here if evicted since), then memory-mapped by every worker
+   for dataset_hash, source in batch_sources.items():
+    save_dataset(DATASET_STORE_DIR, dataset_hash, source, DATASET_STORE_BUDGET)
+   batch_summary, batch_archive = generate_batch_reports(batch_jobs)
+   st.dataframe(batch_summary, hide_index=True, use_container_width=True)
+   st.download_button("⬇️ Download All Reports (ZIP)", batch_archive, file_name="tms_batch_reports.zip",
+                      mime='application/zip', key='download_batch_reports')
+ 
+ # TAB 7: Pivot Explorer
+ with tab7, timed_metric('tms_tab_render_seconds', tab='Pivot Explorer'):
+  st.markdown('<h2 class="section-header">Ad-hoc Pivot over AMS Raw Data</h2>', unsafe_allow_html=True)
+  
+  render_pivot_explorer(tms_data)
+ 
+ # TAB 8: SQL Console
+ with tab8, timed_metric('tms_tab_render_seconds', tab='SQL Console'):
+  st.markdown('<h2 class="section-header">SQL Query Console</h2>', unsafe_allow_html=True)
+  
+  render_sql_console(tms_data)
+
+observe_metric('tms_script_run_seconds', time.perf_counter() - script_start)
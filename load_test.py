@@ -0,0 +1,419 @@
+"""Concurrent-session load test for the TMS dashboard.
+
+Starts app.py on a headless Streamlit server and drives N simulated users over the same websocket
+protocol the browser uses - no browser needed. Each user loads the page, uploads a generated
+workbook, then keeps switching tabs and changing filters. Rerun latency (p50/p95/p99), throughput
+and server memory are reported for every session count.
+
+ pip install -r requirements-dev.txt
+ python load_test.py --sessions 1,2,4,8 --orders 5000 --actions 20
+
+The harness speaks the protocol through streamlit.proto, so it needs the same Streamlit release as the
+server (requirements.txt), plus requests and websockets from requirements-dev.txt.
+
+Tabs switch in the browser without a rerun, so a "tab switch" here is an interaction with a widget
+on a different tab than the previous step - which is what costs server time in a real session.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import numpy as np
+import pandas as pd
+import requests
+from websockets.asyncio.client import connect
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.Common_pb2 import FileUploaderState, FileURLsRequest, UploadedFileInfo
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+# Widgets the simulated users change, grouped by the tab (or sidebar) they live on
+TAB_WIDGETS = {
+ 'Sidebar': ['comparison_mode', 'order_search'],
+ 'Volume Analysis': ['trend_granularity', 'trend_breakdown', 'trend_rolling', 'forecast_granularity', 'forecast_horizon'],
+ 'OTP Performance': ['sla_grace_hours', 'sla_business_days'],
+ 'Financial Analysis': ['margin_dimension', 'whatif_price_all', 'whatif_price_dimension'],
+ 'Lane Network': ['lane_drill_level', 'network_level', 'network_min_volume', 'consolidation_window'],
+ 'Pivot Explorer': ['pivot_rows', 'pivot_cols', 'pivot_measure', 'pivot_filter_dim', 'pivot_filter_values'],
+}
+
+# Widget element types the harness knows how to set, and the WidgetState field each one uses
+WIDGET_VALUE_FIELDS = {
+ 'radio': 'string_value', 'selectbox': 'string_value', 'text_input': 'string_value',
+ 'checkbox': 'bool_value', 'slider': 'double_array_value', 'multiselect': 'string_array_value',
+ 'number_input': 'double_value', 'file_uploader': 'file_uploader_state_value',
+ 'select_slider': 'string_array_value',
+}
+
+FINISHED = {ForwardMsg.FINISHED_SUCCESSFULLY, ForwardMsg.FINISHED_FRAGMENT_RUN_SUCCESSFULLY,
+            ForwardMsg.FINISHED_WITH_COMPILE_ERROR}
+
+
+def generate_workbook(path, orders=5000, seed=0):
+ """Write a synthetic TMS export with the sheets and headers the dashboard reads"""
+ rng = np.random.default_rng(seed)
+ countries = np.array(['NL', 'DE', 'FR', 'IT', 'BE', 'GB', 'AT', 'US', 'AU', 'DK', 'SE', 'ES'])
+ services = np.array(['CTX', 'CX', 'EF', 'EGD', 'FF', 'RGD', 'ROU', 'SF'])
+ order_ids = np.arange(10_000_000 + seed * orders, 10_000_000 + (seed + 1) * orders)
+ pu_ctry = rng.choice(countries, orders)
+ del_ctry = rng.choice(countries, orders)
+ pickup = (pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 180, orders), unit='D')
+           + pd.to_timedelta(rng.integers(6, 18, orders), unit='h'))
+ raw = pd.DataFrame({
+  'TMS Order': order_ids, 'Account': rng.integers(1000, 1040, orders), 'Service': rng.choice(services, orders),
+  'Pickup Date': pickup, 'PU CTRY': pu_ctry, 'PU City': [f'{c}City{i}' for c, i in zip(pu_ctry, rng.integers(0, 4, orders))],
+  'PU Postal': [f'{c}-{i}' for c, i in zip(pu_ctry, rng.integers(1000, 1020, orders))],
+  'DEL CTRY': del_ctry, 'DEL City': [f'{c}City{i}' for c, i in zip(del_ctry, rng.integers(0, 4, orders))],
+  'DEL Postal': [f'{c}-{i}' for c, i in zip(del_ctry, rng.integers(2000, 2020, orders))],
+  'Pieces': rng.integers(1, 6, orders), 'Weight': rng.gamma(2, 10, orders).round(1)})
+ qdt = pickup + pd.to_timedelta(rng.integers(1, 4, orders), unit='D')
+ time_diff = rng.normal(-0.2, 0.6, orders)
+ status = np.where(time_diff <= 0, 'ON TIME', 'LATE')
+ reasons = ['Customer-Requested delay', 'MNX-Incorrect QDT', 'Del Agt-Late del', 'Customer-Shipment not ready']
+ otp = pd.DataFrame({
+  'TMS order': order_ids, 'QDT': qdt, 'POD DATE/TIME': qdt + pd.to_timedelta(time_diff, unit='D'),
+  'Time Diff': time_diff.round(2), 'Status': status,
+  'QC Name': np.where(status == 'LATE', rng.choice(reasons, orders), None)})
+ costs = {name: rng.gamma(shape, scale, orders) for name, shape, scale in
+          [('PU Cost', 2, 20), ('Ship Cost', 3, 30), ('Man Cost', 1, 10), ('Del Cost', 2, 15)]}
+ total_cost = sum(costs.values())
+ revenue = total_cost * rng.normal(1.2, 0.2, orders)
+ cost_sales = pd.DataFrame({
+  'Order Date': (pickup - pd.Timestamp('1899-12-30')).days.astype(float), 'Account': raw['Account'],
+  'Account Name': [f'Customer {i}' for i in raw['Account'] % 40], 'Office': rng.choice(['AMS', 'FRA', 'CDG'], orders),
+  'Order': order_ids, **costs, 'Total Cost': total_cost, 'Net Revenue': revenue,
+  'Currency': rng.choice(['EUR', 'EUR', 'EUR', 'USD', 'GBP'], orders), 'Diff': revenue - total_cost,
+  'Gross %': (revenue - total_cost) / revenue, 'Invoice': [f'INV{i:08d}' for i in order_ids],
+  'Total Amount': revenue * 1.21, 'Status': 'Invoiced', 'PU Country': pu_ctry})
+ with pd.ExcelWriter(path) as writer:
+  raw.to_excel(writer, sheet_name='AMS RAW DATA', index=False)
+  otp.to_excel(writer, sheet_name='OTP POD', index=False)
+  raw['Service'].value_counts().rename_axis('SVC').reset_index(name='Vol').to_excel(
+   writer, sheet_name='Volume per SVC', index=False)
+  pd.crosstab(raw['PU CTRY'], raw['DEL CTRY']).to_excel(writer, sheet_name='Lane usage ')
+  cost_sales.to_excel(writer, sheet_name='cost sales', index=False)
+ return path
+
+
+def _free_port():
+ """An unused local TCP port"""
+ with socket.socket() as sock:
+  sock.bind(('127.0.0.1', 0))
+  return sock.getsockname()[1]
+
+
+def start_server(port, store_dir, startup_timeout=60):
+ """Run app.py on a headless Streamlit server and wait until it answers its health check"""
+ env = dict(os.environ, TMS_DATASET_STORE=store_dir, TMS_API_PORT=str(_free_port()))
+ server = subprocess.Popen(
+  [sys.executable, '-m', 'streamlit', 'run', APP_PATH, '--server.headless', 'true', '--server.port', str(port),
+   '--server.enableXsrfProtection', 'false', '--server.fileWatcherType', 'none',
+   '--browser.gatherUsageStats', 'false'],
+  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+ deadline = time.monotonic() + startup_timeout
+ while time.monotonic() < deadline:
+  if server.poll() is not None:
+   raise RuntimeError(f"Streamlit server exited with code {server.returncode}")
+  try:
+   if requests.get(f'http://127.0.0.1:{port}/_stcore/health', timeout=1).ok:
+    return server
+  except requests.RequestException:
+   pass
+  time.sleep(0.2)
+ stop_server(server)
+ raise RuntimeError(f"Streamlit server did not start within {startup_timeout}s")
+
+
+def stop_server(server):
+ """Terminate the server and its compute workers"""
+ server.terminate()
+ try:
+  server.wait(timeout=30)
+ except subprocess.TimeoutExpired:
+  server.kill()
+  server.wait()
+
+
+def _process_tree(pid):
+ """pid plus every descendant process, read from /proc"""
+ children = {}
+ for entry in os.listdir('/proc'):
+  if entry.isdigit():
+   try:
+    with open(f'/proc/{entry}/stat') as stat:
+     parent = int(stat.read().rsplit(')', 1)[1].split()[1])
+   except (OSError, IndexError, ValueError):
+    continue
+   children.setdefault(parent, []).append(int(entry))
+ tree, pending = [], [pid]
+ while pending:
+  current = pending.pop()
+  tree.append(current)
+  pending.extend(children.get(current, []))
+ return tree
+
+
+def tree_memory(pid):
+ """Proportional set size in bytes of a process and its descendants (forked workers share pages),
+ or None where /proc is unavailable"""
+ if not os.path.isdir('/proc'):
+  return None
+ total = 0
+ for member in _process_tree(pid):
+  for path, field in ((f'/proc/{member}/smaps_rollup', 'Pss:'), (f'/proc/{member}/status', 'VmRSS:')):
+   try:
+    with open(path) as status:
+     value = next((line.split()[1] for line in status if line.startswith(field)), None)
+   except OSError:
+    continue
+   if value is not None:
+    total += int(value) * 1024
+    break
+ return total
+
+
+class Session:
+ """One simulated browser tab: a websocket to the server plus the widget values it has set"""
+
+ def __init__(self, url, rerun_timeout):
+  self.url = url
+  self.rerun_timeout = rerun_timeout
+  self.session_id = None
+  self.widgets = {}
+  self.values = {}
+
+ async def __aenter__(self):
+  self.ws = await connect(f'ws://{self.url}/_stcore/stream', subprotocols=['streamlit'], max_size=None)
+  return self
+
+ async def __aexit__(self, *exc):
+  await self.ws.close()
+
+ async def _send(self, back_msg):
+  await self.ws.send(back_msg.SerializeToString())
+
+ async def _receive(self):
+  message = ForwardMsg()
+  message.ParseFromString(await self.ws.recv())
+  return message
+
+ def _record_widget(self, delta):
+  """Remember the id, element type and fragment of every keyed widget drawn by a run"""
+  element = delta.new_element
+  kind = element.WhichOneof('type')
+  if kind in WIDGET_VALUE_FIELDS:
+   proto = getattr(element, kind)
+   key = proto.id.rsplit('-', 1)[-1] if proto.id.startswith('$$ID-') else None
+   name = key if key and key != 'None' else kind
+   self.widgets[name] = (proto.id, kind, proto, delta.fragment_id)
+
+ async def rerun(self, changed=None):
+  """Rerun the script (or the changed widget's fragment); returns (seconds, error count)"""
+  fragment_id = ''
+  if changed is not None:
+   fragment_id = self.widgets[changed][3]
+   if not fragment_id:
+    self.widgets = {}
+  message = BackMsg()
+  message.rerun_script.fragment_id = fragment_id
+  for widget_id, (kind, value) in self.values.items():
+   state = message.rerun_script.widget_states.widgets.add()
+   state.id = widget_id
+   field = WIDGET_VALUE_FIELDS[kind]
+   if field in ('double_array_value', 'string_array_value'):
+    getattr(state, field).data.extend(value)
+   elif field == 'file_uploader_state_value':
+    state.file_uploader_state_value.CopyFrom(value)
+   else:
+    setattr(state, field, value)
+  errors = 0
+  start = time.perf_counter()
+  await self._send(message)
+  while True:
+   reply = await asyncio.wait_for(self._receive(), self.rerun_timeout)
+   kind = reply.WhichOneof('type')
+   if kind == 'new_session':
+    self.session_id = reply.new_session.initialize.session_id
+   elif kind == 'delta' and reply.delta.WhichOneof('type') == 'new_element':
+    if reply.delta.new_element.WhichOneof('type') == 'exception':
+     errors += 1
+    self._record_widget(reply.delta)
+   elif kind == 'script_finished' and reply.script_finished in FINISHED:
+    return time.perf_counter() - start, errors + (reply.script_finished == ForwardMsg.FINISHED_WITH_COMPILE_ERROR)
+
+ async def upload(self, name, content):
+  """Upload a workbook the way the browser does: request an upload URL, PUT the file, rerun"""
+  request = BackMsg(file_urls_request=FileURLsRequest(request_id=uuid.uuid4().hex, file_names=[name],
+                                                      session_id=self.session_id))
+  await self._send(request)
+  while True:
+   reply = await asyncio.wait_for(self._receive(), self.rerun_timeout)
+   if reply.WhichOneof('type') == 'file_urls_response':
+    break
+  file_urls = reply.file_urls_response.file_urls[0]
+  response = await asyncio.to_thread(requests.put, f'http://{self.url}{file_urls.upload_url}',
+                                     files={'file': (name, content)}, timeout=self.rerun_timeout)
+  response.raise_for_status()
+  widget_id = self.widgets['file_uploader'][0]
+  self.values[widget_id] = ('file_uploader', FileUploaderState(uploaded_file_info=[
+   UploadedFileInfo(name=name, size=len(content), file_id=file_urls.file_id, file_urls=file_urls)]))
+  return await self.rerun()
+
+ def pick_change(self, rng, previous_tab=None):
+  """Choose a widget on a different tab than the last step and a new value for it, or None"""
+  tabs = [tab for tab, keys in TAB_WIDGETS.items() if tab != previous_tab and any(k in self.widgets for k in keys)]
+  if not tabs:
+   return None
+  tab = rng.choice(tabs)
+  key = rng.choice([k for k in TAB_WIDGETS[tab] if k in self.widgets])
+  widget_id, kind, proto, _ = self.widgets[key]
+  current = self.values.get(widget_id, (kind, None))[1]
+  if kind in ('radio', 'selectbox'):
+   options = [o for o in proto.options if o != current] or list(proto.options)
+   value = rng.choice(options) if options else ''
+  elif kind == 'checkbox':
+   value = not (current if current is not None else proto.default)
+  elif kind == 'slider' and proto.options:
+   kind = 'select_slider'
+   indices = sorted(rng.sample(range(len(proto.options)), min(len(proto.default), len(proto.options))))
+   value = [proto.options[i] for i in indices]
+  elif kind == 'slider':
+   steps = np.arange(proto.min, proto.max + proto.step / 2, proto.step).tolist() if proto.step else [proto.min]
+   value = sorted(rng.sample(steps, len(proto.default))) if len(steps) >= len(proto.default) else list(proto.default)
+  elif kind == 'multiselect':
+   value = rng.sample(list(proto.options), min(len(proto.options), rng.randint(1, 3)))
+  elif kind == 'text_input':
+   value = str(rng.randint(10_000, 10_099))
+  else:
+   return None
+  self.values[widget_id] = (kind, value)
+  return tab, key
+
+
+async def run_session(url, workbook, actions, think_seconds, rerun_timeout, seed, delay, samples):
+ """One simulated user: page load, upload, then tab switches and filter changes"""
+ await asyncio.sleep(delay)
+ rng = random.Random(seed)
+ with open(workbook, 'rb') as source:
+  content = source.read()
+ try:
+  async with Session(url, rerun_timeout) as session:
+   samples.append(('load',) + await session.rerun())
+   samples.append(('upload',) + await session.upload(os.path.basename(workbook), content))
+   tab = None
+   for _ in range(actions):
+    await asyncio.sleep(rng.expovariate(1 / think_seconds) if think_seconds > 0 else 0)
+    change = session.pick_change(rng, tab)
+    if change is None:
+     break
+    tab, key = change
+    samples.append(('interaction',) + await session.rerun(key))
+ except (OSError, asyncio.TimeoutError, KeyError, IndexError, requests.RequestException) as e:
+  samples.append(('failed', 0.0, 1))
+  print(f"  session {seed}: {type(e).__name__}: {e}", file=sys.stderr)
+
+
+async def _sample_memory(pid, peaks, interval=0.5):
+ """Track the server's peak memory until cancelled"""
+ while True:
+  memory = tree_memory(pid)
+  if memory is not None:
+   peaks.append(memory)
+  await asyncio.sleep(interval)
+
+
+async def run_level(url, pid, sessions, workbooks, actions, think_seconds, ramp_seconds, rerun_timeout):
+ """Run ``sessions`` concurrent users against a running server and collect their samples"""
+ samples, memory = [], []
+ sampler = asyncio.create_task(_sample_memory(pid, memory))
+ start = time.perf_counter()
+ await asyncio.gather(*(run_session(url, workbooks[i % len(workbooks)], actions, think_seconds, rerun_timeout,
+                                    i, i * ramp_seconds, samples) for i in range(sessions)))
+ elapsed = time.perf_counter() - start
+ sampler.cancel()
+ return samples, memory, elapsed
+
+
+def summarize_level(sessions, samples, memory, elapsed):
+ """Latency percentiles in ms, throughput and peak memory of one load level"""
+ summary = {'sessions': sessions, 'seconds': round(elapsed, 1), 'reruns': 0,
+            'errors': sum(errors for _, _, errors in samples),
+            'failed_sessions': sum(1 for phase, _, _ in samples if phase == 'failed')}
+ for phase in ('load', 'upload', 'interaction'):
+  latencies = np.array([seconds for p, seconds, _ in samples if p == phase]) * 1000
+  summary['reruns'] += len(latencies)
+  for q in (50, 95, 99):
+   summary[f'{phase}_p{q}_ms'] = round(float(np.percentile(latencies, q)), 1) if len(latencies) else None
+ summary['reruns_per_second'] = round(summary['reruns'] / elapsed, 2) if elapsed else None
+ summary['peak_memory_mb'] = round(max(memory) / 2 ** 20, 1) if memory else None
+ return summary
+
+
+def print_report(results):
+ """One row per session count"""
+ columns = [('sessions', 'Sessions'), ('reruns', 'Reruns'), ('errors', 'Errors'),
+            ('interaction_p50_ms', 'p50 ms'), ('interaction_p95_ms', 'p95 ms'), ('interaction_p99_ms', 'p99 ms'),
+            ('upload_p50_ms', 'Upload p50'), ('upload_p95_ms', 'Upload p95'),
+            ('reruns_per_second', 'Reruns/s'), ('peak_memory_mb', 'Peak MB')]
+ print(' '.join(f'{title:>10}' for _, title in columns))
+ for result in results:
+  print(' '.join(f"{'-' if result[key] is None else result[key]:>10}" for key, _ in columns))
+
+
+def main(argv=None):
+ parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+ parser.add_argument('--sessions', default='1,2,4,8', help="comma-separated concurrent session counts")
+ parser.add_argument('--orders', type=int, default=5000, help="orders per generated workbook")
+ parser.add_argument('--workbooks', type=int, default=1,
+                     help="distinct workbooks, assigned to sessions round-robin (1 = all sessions share one)")
+ parser.add_argument('--workbook', action='append', help="use this workbook instead of generating (repeatable)")
+ parser.add_argument('--actions', type=int, default=20, help="tab switches/filter changes per session")
+ parser.add_argument('--think', type=float, default=1.0, help="mean think time between actions, in seconds")
+ parser.add_argument('--ramp', type=float, default=0.5, help="seconds between session starts")
+ parser.add_argument('--timeout', type=float, default=600, help="seconds before a rerun counts as failed")
+ parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'tms_load_test'),
+                     help="where generated workbooks and per-level dataset stores are kept")
+ parser.add_argument('--json', help="also write the results to this file")
+ args = parser.parse_args(argv)
+
+ os.makedirs(args.workdir, exist_ok=True)
+ workbooks = args.workbook or []
+ for seed in range(0 if workbooks else args.workbooks):
+  path = os.path.join(args.workdir, f'tms_{args.orders}_{seed}.xlsx')
+  if not os.path.exists(path):
+   print(f"Generating {path}")
+   generate_workbook(path, args.orders, seed)
+  workbooks.append(path)
+
+ results = []
+ for sessions in [int(n) for n in args.sessions.split(',')]:
+  port = _free_port()
+  # Every level starts cold: its own server process and an empty dataset store
+  store_dir = tempfile.mkdtemp(prefix='store_', dir=args.workdir)
+  server = start_server(port, store_dir)
+  try:
+   print(f"Running {sessions} session(s)")
+   samples, memory, elapsed = asyncio.run(run_level(f'127.0.0.1:{port}', server.pid, sessions, workbooks,
+                                                    args.actions, args.think, args.ramp, args.timeout))
+  finally:
+   stop_server(server)
+   shutil.rmtree(store_dir, ignore_errors=True)
+  results.append(summarize_level(sessions, samples, memory, elapsed))
+ print_report(results)
+ if args.json:
+  with open(args.json, 'w') as out:
+   json.dump(results, out, indent=1)
+ return results
+
+
+if __name__ == '__main__':
+ main()
@@ -0,0 +1,573 @@
+import io
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+import pytest
+
+import load_test
+import tms_analytics
+
+
+def _orders():
+ """Three same-lane, same-day shipments, with cost sales read as floats (one blank order number)"""
+ raw_df = pd.DataFrame({
+  'TMS_Order': [1000001, 1000002, 1000003],
+  'Pickup_Date': pd.to_datetime(['2025-03-03 08:00', '2025-03-03 10:00', '2025-03-03 12:00']),
+  'PU_Country': ['NL'] * 3, 'DEL_Country': ['DE'] * 3
+ })
+ cost_df = pd.DataFrame({
+  'Order_Num': [1000001.0, 1000002.0, 1000003.0, np.nan],
+  'PU_Cost': [5.0, 10.0, 15.0, 50.0], 'Ship_Cost': [5.0, 10.0, 15.0, 50.0],
+  'Net_Revenue': [100.0, 200.0, 300.0, 1000.0], 'Total_Cost': [10.0, 20.0, 30.0, 100.0],
+  'PU_Country': ['NL'] * 4
+ })
+ return raw_df, cost_df
+
+
+def test_consolidation_matches_float_order_numbers():
+ raw_df, cost_df = _orders()
+ result = tms_analytics.find_consolidation_candidates(raw_df, cost_df, window_hours=24, lane_level='Country')
+ # Per-order PU + Ship costs 10, 20 and 30: one pickup remains, so 10 + 20 is saved
+ assert result['est_savings'] == pytest.approx(30.0)
+
+
+def _otp(raw_df):
+ return pd.DataFrame({
+  'TMS_Order': raw_df['TMS_Order'],
+  'QDT': pd.to_datetime(['2025-03-04 12:00'] * 3),
+  'POD_DateTime': pd.to_datetime(['2025-03-04 10:00', '2025-03-04 11:00', '2025-03-05 12:00']),
+  'Status': ['ON TIME', 'ON TIME', 'LATE']
+ })
+
+
+def test_lane_profiles_match_float_order_numbers():
+ raw_df, cost_df = _orders()
+ profiles = tms_analytics.build_lane_profiles(_otp(raw_df), raw_df, cost_df)
+ # Revenue 100, 200 and 300 per order, not the overall mean with no spread
+ assert profiles['revenue'][0] == pytest.approx([200.0, 100.0])
+ assert profiles['cost'][0] == pytest.approx([20.0, 10.0])
+
+
+@pytest.mark.skipif(not tms_analytics.SQL_CONSOLE_AVAILABLE, reason="duckdb is not installed")
+def test_sql_console_queries_registered_frames():
+ tables = {'otp': pd.DataFrame({'TMS_Order': [1, 2, 3]})}
+ result, total_rows, _ = tms_analytics.run_sql_query(tables, 'SELECT sum(TMS_Order) AS s FROM otp')
+ assert total_rows == 1
+ assert result['s'].iloc[0] == 6
+
+
+@pytest.mark.skipif(not tms_analytics.SQL_CONSOLE_AVAILABLE, reason="duckdb is not installed")
+@pytest.mark.parametrize('sql', [
+ "SELECT * FROM read_text('{path}')",
+ "SELECT * FROM read_csv('{path}')",
+ "SELECT * FROM '{path}'",
+])
+def test_sql_console_cannot_read_server_files(tmp_path, sql):
+ path = tmp_path / 'secret.csv'
+ path.write_text('secret\n1\n')
+ tables = {'otp': pd.DataFrame({'TMS_Order': [1]})}
+ with pytest.raises(tms_analytics.duckdb.Error, match='(?i)permission'):
+  tms_analytics.run_sql_query(tables, sql.format(path=path))
+
+
+@pytest.fixture
+def kpi_server():
+ server = tms_analytics.start_kpi_server(tms_analytics.new_kpi_store(), port=0)
+ yield server
+ server.shutdown()
+ server.server_close()
+
+
+def _api_request_series():
+ return {key for key in tms_analytics._metric_values['values'] if key[0] == 'tms_api_requests_total'}
+
+
+def test_api_metrics_use_fixed_route_labels(kpi_server):
+ import urllib.error
+ import urllib.request
+ port = kpi_server.server_address[1]
+ for n in range(20):
+  with pytest.raises(urllib.error.HTTPError):
+   urllib.request.urlopen(f'http://127.0.0.1:{port}/junk{n}')
+ urllib.request.urlopen(f'http://127.0.0.1:{port}/health').read()
+ endpoints = {dict(labels)['endpoint'] for _, labels in _api_request_series()}
+ assert endpoints <= {'health', 'metrics', 'datasets', 'dataset_kpis', 'kpis', 'other'}
+
+
+def test_api_rejects_malformed_request_line(kpi_server):
+ import socket
+ with socket.create_connection(kpi_server.server_address[:2], timeout=5) as sock:
+  sock.sendall(b'GET / HTTP/9.9\r\n\r\n')
+  reply = sock.recv(1024)
+ # An HTTP/0.9-style reply: just the error page, which an unparsed request used to lose to an AttributeError
+ assert re.search(rb'Error code: (400|505)', reply)
+
+
+def _stored_dataset():
+ volumes = pd.DataFrame({'CX': [3, 4]}, index=pd.MultiIndex.from_tuples([('NL', 'AMS'), ('DE', 'BER')], names=['Country', 'City']))
+ return {
+  'raw_data': _orders()[0].assign(Mode=pd.Categorical(['Road', 'Air', 'Road'])),
+  'volumes': volumes,
+  'lanes': volumes['CX'].rename(None),
+  'mixed': pd.DataFrame({'Ref': [1, 'A-2', None]}),
+  'sort_index': {'Weight': (np.array([2, 0, 1]), 2)},
+  'search_index': {'keys': np.array(['nl', 'de']), 'records': np.array([0, 1])},
+  'matrix': {'NL': {'CX': 3}},
+  'periods': ['2025-01'],
+  'total_volume': np.int64(7),
+ }
+
+
+def test_dataset_store_round_trip(tmp_path):
+ data = _stored_dataset()
+ assert tms_analytics.save_dataset(str(tmp_path / 'store'), 'key', data)
+ assert not list((tmp_path / 'store' / 'key').glob('*.pkl'))
+ stored = tms_analytics.load_dataset(str(tmp_path / 'store'), 'key')
+ for key in ('raw_data', 'volumes', 'mixed'):
+  pd.testing.assert_frame_equal(stored[key], data[key])
+ pd.testing.assert_series_equal(stored['lanes'], data['lanes'])
+ order, count = stored['sort_index']['Weight']
+ assert order.tolist() == [2, 0, 1] and count == 2
+ assert stored['search_index']['keys'].tolist() == ['nl', 'de']
+ assert (stored['matrix'], stored['periods'], stored['total_volume']) == (data['matrix'], data['periods'], 7)
+ assert list(tms_analytics.load_dataset(str(tmp_path / 'store'), 'key', ('volumes',))) == ['volumes']
+
+
+def test_dataset_store_refuses_shared_directory(tmp_path):
+ store = tmp_path / 'store'
+ assert tms_analytics.save_dataset(str(store), 'key', _stored_dataset())
+ assert store.stat().st_mode & 0o777 == 0o700
+ store.chmod(0o777)
+ assert tms_analytics.load_dataset(str(store), 'key') is None
+ assert tms_analytics.save_dataset(str(store), 'other', _stored_dataset()) is None
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason="no POSIX owners")
+def test_dataset_store_refuses_other_users_directory(tmp_path, monkeypatch):
+ store = tmp_path / 'store'
+ assert tms_analytics.save_dataset(str(store), 'key', _stored_dataset())
+ monkeypatch.setattr(os, 'getuid', lambda: store.stat().st_uid + 1)
+ assert tms_analytics.load_dataset(str(store), 'key') is None
+
+
+def test_dataset_key_covers_parse_inputs(tmp_path):
+ fx_rates = tmp_path / 'fx_rates.csv'
+ fx_rates.write_text('Currency,Rate\nUSD,0.9\n')
+ key = tms_analytics.dataset_key(b'workbook', ['TMS_Order'], ['Order_Num'], ['Damage'], str(fx_rates))
+ assert key == tms_analytics.dataset_key(b'workbook', ['TMS_Order'], ['Order_Num'], ['Damage'], str(fx_rates))
+ assert key != tms_analytics.dataset_key(b'workbook', ['TMS_Order', 'Account'], ['Order_Num'], ['Damage'], str(fx_rates))
+ assert key != tms_analytics.dataset_key(b'workbook', ['TMS_Order'], ['Order_Num'], ['Damage', 'Delay'], str(fx_rates))
+ assert key != tms_analytics.dataset_key(b'workbook', ['TMS_Order'], ['Order_Num'], ['Damage'], str(tmp_path / 'none.csv'))
+ fx_rates.write_text('Currency,Rate\nUSD,0.8\n')
+ assert key != tms_analytics.dataset_key(b'workbook', ['TMS_Order'], ['Order_Num'], ['Damage'], str(fx_rates))
+
+
+def test_excel_export_continues_long_frames_on_new_sheets():
+ import io
+ from openpyxl import load_workbook
+ frame = pd.DataFrame({'TMS_Order': range(5)})
+ workbook = load_workbook(io.BytesIO(tms_analytics.excel_export({'Orders': frame, 'Empty': frame.iloc[:0]}, sheet_rows=2)))
+ assert workbook.sheetnames == ['Orders', 'Orders (2)', 'Orders (3)', 'Empty']
+ rows = [list(workbook[name].values) for name in workbook.sheetnames]
+ assert rows == [[('TMS_Order',), (0,), (1,)], [('TMS_Order',), (2,), (3,)], [('TMS_Order',), (4,)], [('TMS_Order',)]]
+
+
+def test_delivery_window_moves_weekend_and_holiday_pods_to_next_opening():
+ otp = pd.DataFrame({
+  'QDT': pd.to_datetime(['2024-06-03 18:00', '2024-12-26 18:00', '2024-06-04 18:00', '2024-06-04 18:00']),
+  # Saturday, Christmas Day (NL holiday, as is the 26th), Tuesday after closing, Tuesday in the window
+  'POD_DateTime': pd.to_datetime(['2024-06-01 10:00', '2024-12-25 10:00', '2024-06-04 19:00', '2024-06-04 12:00'])
+ })
+ result = tms_analytics.compute_lateness(otp, countries=['NL'] * 4, sla={'delivery_window': (8, 18)})
+ assert result['Effective_POD'].tolist() == list(pd.to_datetime(
+  ['2024-06-03 08:00', '2024-12-27 08:00', '2024-06-05 08:00', '2024-06-04 12:00']))
+ assert result['SLA_Status'].tolist() == ['ON TIME', 'LATE', 'LATE', 'ON TIME']
+
+
+def test_run_jobs_fans_out_past_the_owner_limit():
+ import time
+ pool = tms_analytics.new_compute_pool(workers=2, max_queued=8, owner_limit=1, niceness=0)
+ try:
+  # Warm up both workers so their start-up time does not count
+  tms_analytics.run_jobs(pool, 'warm', 'test', time.sleep, [(0,), (0,)], owner='session', owner_limit=2)
+  started = time.monotonic()
+  results = tms_analytics.run_jobs(pool, 'sleep', 'test', time.sleep, [(0.5,)] * 4, owner='session', owner_limit=2)
+  elapsed = time.monotonic() - started
+ finally:
+  tms_analytics.close_compute_pool(pool)
+ assert results == [None] * 4
+ assert elapsed < 1.8
+
+
+def test_run_jobs_waits_for_room_when_the_queue_is_full():
+ pool = tms_analytics.new_compute_pool(workers=1, max_queued=1, niceness=0)
+ try:
+  results = tms_analytics.run_jobs(pool, 'abs', 'test', abs, [(-n,) for n in range(6)], owner='session')
+ finally:
+  tms_analytics.close_compute_pool(pool)
+ assert results == list(range(6))
+
+
+def test_simulation_chunks_on_the_compute_pool_match_an_inline_run():
+ raw_df, cost_df = _orders()
+ profiles = tms_analytics.build_lane_profiles(_otp(raw_df), raw_df, cost_df)
+ scenario = {'hub_growth': 20.0}
+ pool = tms_analytics.new_compute_pool(workers=2, niceness=0)
+ try:
+  pooled = tms_analytics.run_simulation(profiles, scenario, 12000, lambda func, arg_list: tms_analytics.run_jobs(
+   pool, 'simulation', 'simulation', func, arg_list, owner='session', owner_limit=2))
+ finally:
+  tms_analytics.close_compute_pool(pool)
+ inline = tms_analytics.run_simulation(profiles, scenario, 12000)
+ assert len(pooled['volume']) == 12000
+ for key in ('volume', 'on_time', 'revenue', 'cost'):
+  np.testing.assert_array_equal(pooled[key], inline[key])
+
+
+def test_compute_workers_do_not_run_the_app_script(tmp_path):
+ import subprocess
+ import sys
+ import textwrap
+ # Streamlit runs the app as sys.modules['__main__']; a worker that imported it would create the marker
+ marker = tmp_path / 'imported'
+ script = tmp_path / 'app_script.py'
+ script.write_text(f'open({str(marker)!r}, "w").close()\n')
+ driver = textwrap.dedent(f"""
+  import sys, types
+  import tms_analytics
+  app = types.ModuleType('__main__')
+  app.__file__ = {str(script)!r}
+  sys.modules['__main__'] = app
+  pool = tms_analytics.new_compute_pool(workers=1, niceness=0)
+  print(tms_analytics.run_jobs(pool, 'abs', 'test', abs, [(-3,)]))
+  tms_analytics.close_compute_pool(pool)
+ """)
+ root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ result = subprocess.run([sys.executable, '-c', driver], cwd=root, capture_output=True, text=True, timeout=120,
+                         env=dict(os.environ, PYTHONPATH=root))
+ assert result.stdout.strip() == '[3]', result.stderr
+ assert not marker.exists()
+
+
+def _pivot_rows():
+ rng = np.random.default_rng(0)
+ return pd.DataFrame({'Country': rng.choice(['NL', 'DE', 'FR'], 300), 'Service': rng.choice(['CX', 'EF'], 300),
+                      'Office': rng.choice(['AMS', 'RTM'], 300), 'Weight': rng.uniform(1, 100, 300)})
+
+
+def test_pivot_aggregate_rolls_up_cached_groupings():
+ rows = _pivot_rows()
+ cache = tms_analytics.new_pivot_cache()
+ _, source = tms_analytics.pivot_aggregate(rows, ['Country', 'Service'], 'Weight', {}, cache)
+ rolled, rolled_source = tms_analytics.pivot_aggregate(rows, ['Country'], 'Weight', {}, cache)
+ scanned, _ = tms_analytics.pivot_aggregate(rows, ['Country'], 'Weight', {}, tms_analytics.new_pivot_cache())
+ assert (source, rolled_source) == ('scan', 'rollup')
+ pd.testing.assert_frame_equal(rolled, scanned)
+ assert tms_analytics.pivot_aggregate(rows, ['Country'], 'Weight', {}, cache)[1] == 'cache'
+
+
+def test_pivot_cache_is_safe_across_concurrent_sessions():
+ from concurrent.futures import ThreadPoolExecutor
+ rows = _pivot_rows()
+ cache = tms_analytics.new_pivot_cache()
+ groupings = [['Country'], ['Service'], ['Office'], ['Country', 'Service'], ['Country', 'Office'], ['Service', 'Office']]
+ requests = [(groupings[n % len(groupings)], {'Country': ['NL', 'DE'][:1 + n % 2]}) for n in range(300)]
+ with ThreadPoolExecutor(8) as executor:
+  results = list(executor.map(lambda request: tms_analytics.pivot_aggregate(rows, request[0], 'Weight', request[1], cache,
+                                                                            max_entries=4), requests))
+ assert len(results) == 300 and len(cache['entries']) <= 4
+
+
+def test_kpi_server_reports_a_taken_port(kpi_server):
+ with pytest.raises(OSError):
+  tms_analytics.start_kpi_server(tms_analytics.new_kpi_store(), *kpi_server.server_address[:2])
+
+
+def _shipments(n=400):
+ rng = np.random.default_rng(1)
+ country = rng.choice(['NL', 'DE', 'FR', 'US'], n)
+ city = np.char.add(country, rng.choice(['City0', 'City1'], n))
+ dest = rng.choice(['NL', 'DE', 'GB', 'AU'], n)
+ dest_city = np.char.add(dest, rng.choice(['City0', 'City1', 'City2'], n))
+ return pd.DataFrame({
+  'PU_Country': country, 'PU_City': city, 'PU_Postcode': np.char.add(city, rng.choice(['-1', '-2'], n)),
+  'DEL_Country': dest, 'DEL_City': dest_city, 'DEL_Postcode': np.char.add(dest_city, rng.choice(['-1', '-2'], n)),
+  'Service': rng.choice(['CX', 'EF', 'ROU'], n), 'Weight': rng.uniform(1, 500, n)
+ })
+
+
+def test_geo_rollups_agree_across_levels():
+ raw_df = _shipments()
+ rollups = tms_analytics.build_geo_rollups(raw_df)
+ assert rollups['levels'] == ['Region', 'Country', 'City', 'Postcode']
+ for level in rollups['levels']:
+  lanes = rollups['lanes'][level]
+  assert lanes['Volume'].sum() == len(raw_df)
+  assert lanes['Weight'].sum() == pytest.approx(raw_df['Weight'].sum())
+  assert rollups['volumes'][level].to_numpy().sum() == len(raw_df)
+  by_parent = {parent: group for parent, group in rollups['drill'][level].items() if parent != 'All'}
+  assert sum(len(group) for group in (by_parent or {'All': lanes}).values()) == len(lanes)
+ # Rolled up from the finer levels, the country lanes match grouping the rows directly
+ direct = raw_df.groupby(['PU_Country', 'DEL_Country'])['Weight'].agg(['size', 'sum'])
+ countries = rollups['lanes']['Country'].set_index(['PU_Country', 'DEL_Country']).sort_index()
+ assert countries['Volume'].tolist() == direct['size'].tolist()
+ np.testing.assert_allclose(countries['Weight'].to_numpy(), direct['sum'].to_numpy())
+
+
+def test_lane_network_pagerank_and_reciprocal_imbalance():
+ lanes = pd.DataFrame({'Origin': ['NL', 'DE', 'NL', 'FR', 'GB', 'NL'],
+                       'Destination': ['DE', 'NL', 'FR', 'NL', 'NL', 'DE'],
+                       'Volume': [30, 10, 5, 5, 8, 10]})
+ network = tms_analytics.lane_network_metrics(lanes, hub='NL')
+ assert network['nodes']['Hub_Centrality'].sum() == pytest.approx(1.0)
+ assert network['nodes']['Node'].iloc[0] == 'NL'
+ pairs = network['pairs'].set_index(['Node_A', 'Node_B'])
+ # Duplicate NL->DE lanes merge: 40 one way, 10 back
+ assert pairs.loc[('DE', 'NL'), ['Flow_A_to_B', 'Flow_B_to_A']].tolist() == [10, 40]
+ assert pairs.loc[('DE', 'NL'), 'Imbalance'] == pytest.approx(-0.6)
+ assert pairs.loc[('FR', 'NL'), 'Imbalance'] == 0
+ assert pairs.loc[('GB', 'NL'), 'Imbalance'] == 1
+ assert network['summary']['reciprocal_pairs'] == 2
+ assert network['summary']['hub_flow_share'] == 1.0
+
+
+def _cost_sales(n=300):
+ rng = np.random.default_rng(2)
+ components = {col: rng.uniform(5, 60, n) for col in ('PU_Cost', 'Ship_Cost', 'Man_Cost', 'Del_Cost')}
+ return pd.DataFrame({
+  'Order_Num': np.arange(n) + 5000.0, 'Order_Date': pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 90, n), 'D'),
+  'PU_Country': rng.choice(['NL', 'DE', 'FR'], n), 'Account_Name': rng.choice(['Acme', 'Globex', 'Initech'], n),
+  'Office': rng.choice(['AMS', 'RTM'], n), 'Net_Revenue': rng.uniform(50, 400, n),
+  **components, 'Total_Cost': sum(components.values())
+ })
+
+
+def test_rollup_margin_is_total_profit_over_total_revenue():
+ cost_df = _cost_sales()
+ base = tms_analytics.build_financial_base(cost_df)
+ assert len(base) < len(cost_df) and base['Orders'].sum() == len(cost_df)
+ by_country = tms_analytics.rollup_financials(base, ['Country'])
+ for country, rows in cost_df.groupby('PU_Country'):
+  revenue, cost = rows['Net_Revenue'].sum(), rows['Total_Cost'].sum()
+  assert by_country.loc[country, 'Net_Revenue'] == pytest.approx(revenue)
+  assert by_country.loc[country, 'Profit'] == pytest.approx(revenue - cost)
+  assert by_country.loc[country, 'Margin_Percent'] == round((revenue - cost) / revenue * 100, 1)
+
+
+def test_order_search_matches_prefixes_only_within_their_range():
+ otp_df = pd.DataFrame({'TMS_Order': [1000, 1001, 10010, 1002.0, 2000], 'Status': ['ON TIME', 'LATE', 'ON TIME', 'LATE', 'LATE']})
+ cost_df = pd.DataFrame({'Order_Num': [1000.0, 2000.0], 'Invoice_Num': ['INV-1000', 'INV-2'], 'Account_Name': ['Acme', 'acme b.v.'],
+                         'Net_Revenue': [100.0, 50.0], 'Total_Cost': [80.0, 60.0]})
+ index = tms_analytics.build_search_index(otp_df, cost_df)
+ orders, total = tms_analytics.search_orders(index, '100')
+ assert sorted(orders['Order']) == ['1000', '1001', '10010', '1002'] and total == 4
+ # The prefix is an exact boundary: '1001' matches 1001 and 10010 but not 1000 or 1002
+ assert sorted(tms_analytics.search_orders(index, '1001')[0]['Order']) == ['1001', '10010']
+ assert tms_analytics.search_orders(index, '10011')[1] == 0
+ assert tms_analytics.search_orders(index, '') is None
+ # Case-insensitive, and a record matched on several fields is returned once
+ acme, total = tms_analytics.search_orders(index, ' acme')
+ assert sorted(acme['Order']) == ['1000', '2000'] and total == 2
+ invoice = tms_analytics.search_orders(index, 'inv-1')[0]
+ assert invoice['Order'].tolist() == ['1000'] and invoice['Matched_On'].tolist() == ['Invoice_Num']
+ assert tms_analytics.search_orders(index, '1', limit=2)[0]['Order'].tolist() == ['1000', '1001']
+
+
+def test_snapshot_deltas_match_the_rows_of_each_period():
+ raw_df = _shipments(200).assign(Pickup_Date=pd.Timestamp('2025-01-01') + pd.to_timedelta(np.arange(200) % 90, 'D'))
+ otp_df = pd.DataFrame({
+  'QDT': raw_df['Pickup_Date'], 'Status': np.where(np.arange(200) % 3, 'ON TIME', 'LATE'),
+  'QC_Name': np.where(np.arange(200) % 4 == 0, 'Customs delay', np.where(np.arange(200) % 5 == 0, 'Weather', ''))
+ })
+ cost_df = _cost_sales()
+ aggregates = tms_analytics.build_period_aggregates(otp_df, tms_analytics.build_financial_base(cost_df), raw_df, ('Customs', 'Weather'))
+ assert aggregates['periods'] == ['2025-01', '2025-02', '2025-03']
+ current = tms_analytics.snapshot_aggregates(aggregates, ['2025-03'])
+ baseline = tms_analytics.snapshot_aggregates(aggregates, ['2025-01', '2025-02'])
+ in_march = raw_df['Pickup_Date'].dt.month == 3
+ assert current['volume'] == in_march.sum() and baseline['volume'] == (~in_march).sum()
+ assert current['otp_percent'] == pytest.approx((otp_df['Status'][in_march] == 'ON TIME').mean() * 100)
+ march_sales = cost_df[cost_df['Order_Date'].dt.month == 3]
+ assert current['revenue'] == pytest.approx(march_sales['Net_Revenue'].sum())
+ comparison = tms_analytics.compare_snapshots(current, baseline)
+ kpis = comparison['kpis'].set_index('Metric')
+ assert kpis.loc['Volume (shipments)', 'Delta'] == in_march.sum() - (~in_march).sum()
+ earlier_cost = cost_df['Total_Cost'].sum() - march_sales['Total_Cost'].sum()
+ assert kpis.loc['Cost', 'Delta'] == pytest.approx(march_sales['Total_Cost'].sum() - earlier_cost)
+ assert comparison['qc'].loc['Customs', 'Current'] == otp_df['QC_Name'][in_march].str.contains('Customs').sum()
+ assert comparison['qc'][['Baseline Share %', 'Current Share %']].sum().tolist() == pytest.approx([100.0, 100.0])
+ lanes = comparison['lanes']
+ assert lanes['Current'].sum() == in_march.sum() and (lanes['Delta'] == lanes['Current'] - lanes['Baseline']).all()
+ # Re-collapsing all periods reproduces the full-data snapshot
+ assert tms_analytics.snapshot_aggregates(aggregates)['volume'] == len(raw_df)
+
+
+def _assert_same_trend_state(state, expected):
+ columns = expected['daily'].columns
+ for name in ('daily', 'cumulative'):
+  pd.testing.assert_frame_equal(state[name].reindex(columns=columns), expected[name], check_dtype=False, check_freq=False)
+ for window, rolling in expected['rolling'].items():
+  pd.testing.assert_frame_equal(state['rolling'][window].reindex(columns=columns), rolling, check_dtype=False, check_freq=False)
+
+
+@pytest.mark.parametrize('split_day', [10, 40])
+def test_extending_a_trend_state_matches_a_full_rebuild(split_day):
+ raw_df = _shipments(300).assign(Pickup_Date=pd.Timestamp('2025-01-01') + pd.to_timedelta(np.arange(300) % 70, 'D'))
+ # A destination that only appears in the appended days adds a series
+ raw_df.loc[raw_df['Pickup_Date'] >= pd.Timestamp('2025-01-01') + pd.Timedelta(days=split_day), 'DEL_Country'] = 'BE'
+ matrix = tms_analytics.daily_matrix(tms_analytics.build_daily_rollup(raw_df=raw_df), 'Country')
+ split = matrix.index[0] + pd.Timedelta(days=split_day)
+ history = matrix.loc[:split - pd.Timedelta(days=1)]
+ history = history.loc[:, history.sum() > 0]
+ expected = tms_analytics.build_trend_state(matrix)
+ extended = tms_analytics.extend_trend_state(tms_analytics.build_trend_state(history), matrix.loc[split:])
+ _assert_same_trend_state(extended, expected)
+ _assert_same_trend_state(tms_analytics.refresh_trend_state(tms_analytics.build_trend_state(history), matrix), expected)
+ # Restating already materialized days falls back to a rebuild with the same result
+ restated = tms_analytics.extend_trend_state(tms_analytics.build_trend_state(history), matrix.loc[split - pd.Timedelta(days=5):])
+ _assert_same_trend_state(restated, expected)
+
+
+def test_whatif_rollups_match_a_row_level_recomputation():
+ cost_df = _cost_sales()
+ base = tms_analytics.build_financial_base(cost_df)
+ price_changes, cost_changes = {'NL': 10.0, 'FR': -5.0}, {'Ship_Cost': 20.0, 'Del_Cost': -10.0}
+ adjusted = tms_analytics.whatif_financials(base, 'Country', price_changes, global_price_change=2.0, cost_changes=cost_changes)
+ rows = cost_df.copy()
+ rows['Net_Revenue'] *= 1 + (2.0 + rows['PU_Country'].map(price_changes).fillna(0)) / 100
+ for col, change in cost_changes.items():
+  rows[col] *= 1 + change / 100
+ rows['Total_Cost'] = rows[['PU_Cost', 'Ship_Cost', 'Man_Cost', 'Del_Cost']].sum(axis=1)
+ for dimension, col in (('Country', 'PU_Country'), ('Account', 'Account_Name')):
+  rollup = tms_analytics.rollup_financials(adjusted, [dimension])
+  for value, group in rows.groupby(col):
+   revenue, cost = group['Net_Revenue'].sum(), group['Total_Cost'].sum()
+   assert rollup.loc[value, 'Net_Revenue'] == pytest.approx(revenue)
+   assert rollup.loc[value, 'Total_Cost'] == pytest.approx(cost)
+   assert rollup.loc[value, 'Margin_Percent'] == round((revenue - cost) / revenue * 100, 1)
+ # The base itself is left untouched
+ assert base['Net_Revenue'].sum() == pytest.approx(cost_df['Net_Revenue'].sum())
+
+
+def _workbook(sheets):
+ buffer = io.BytesIO()
+ with pd.ExcelWriter(buffer) as writer:
+  for name, frame in sheets.items():
+   frame.to_excel(writer, sheet_name=name, index=False)
+ return buffer.getvalue()
+
+
+def _assert_same_dataset(value, expected):
+ if isinstance(expected, (pd.DataFrame, pd.Series)):
+  assert type(value) is type(expected)
+  (pd.testing.assert_frame_equal if isinstance(expected, pd.DataFrame) else pd.testing.assert_series_equal)(value, expected)
+ elif isinstance(expected, (np.ndarray, pd.Index)):
+  np.testing.assert_array_equal(value, expected)
+ elif isinstance(expected, dict):
+  assert value.keys() == expected.keys()
+  for key in expected:
+   _assert_same_dataset(value[key], expected[key])
+ elif isinstance(expected, (list, tuple)):
+  assert len(value) == len(expected)
+  for item, expected_item in zip(value, expected):
+   _assert_same_dataset(item, expected_item)
+ else:
+  assert value == expected
+
+
+def test_incremental_reingestion_matches_a_full_parse(tmp_path):
+ sheets = pd.read_excel(load_test.generate_workbook(tmp_path / 'tms.xlsx', orders=400), sheet_name=None)
+ otp = sheets['OTP POD'].copy()
+ otp.loc[:49, 'Status'] = 'LATE'
+ qc_reasons = ('Customer', 'MNX')
+ previous = tms_analytics.parse_tms_workbook(_workbook(sheets), 'v1', qc_reasons=qc_reasons)
+ content = _workbook({**sheets, 'OTP POD': otp})
+ incremental = tms_analytics.parse_tms_workbook(content, 'v2', qc_reasons=qc_reasons, previous=previous)
+ full = tms_analytics.parse_tms_workbook(content, 'v2', qc_reasons=qc_reasons)
+ # Only the edited sheet is re-read; what derives from the others is carried over
+ assert [sheet for sheet, digest in full['sheet_hashes'].items() if digest != previous['sheet_hashes'][sheet]] == ['OTP POD']
+ assert incremental['raw_data'] is previous['raw_data'] and incremental['otp'] is not previous['otp']
+ _assert_same_dataset(incremental, full)
+
+
+def test_explorer_pages_follow_the_sort_order_with_nulls_last():
+ frame = pd.DataFrame({'Weight': [3.0, np.nan, 1.0, 2.0, np.nan, 5.0], 'Status': ['LATE', 'ON TIME', None, 'LATE', 'LATE', 'ON TIME']})
+ sort_index = tms_analytics.build_sort_index(frame, ['Weight', 'Status'])
+ assert tms_analytics.explorer_positions(sort_index, 'Weight').tolist() == [2, 3, 0, 5, 1, 4]
+ # Descending reverses the valid values only; blanks stay at the end in their original order
+ assert tms_analytics.explorer_positions(sort_index, 'Weight', descending=True).tolist() == [5, 0, 3, 2, 1, 4]
+ late = (frame['Status'] == 'LATE').to_numpy()
+ positions = tms_analytics.explorer_positions(sort_index, 'Weight', descending=True, mask=late)
+ assert positions.tolist() == [0, 3, 4]
+ page_size = 2
+ pages = [frame.iloc[positions[start:start + page_size]] for start in range(0, len(positions), page_size)]
+ assert pd.concat(pages)['Weight'].tolist()[:2] == [3.0, 2.0] and len(pages) == 2
+ assert tms_analytics.explorer_positions(sort_index, 'Status').tolist() == [0, 3, 4, 1, 5, 2]
+
+
+def test_batched_forecast_fit_matches_fitting_each_series_alone():
+ rng = np.random.default_rng(3)
+ days = np.arange(120)
+ values = np.column_stack([50 + 10 * np.sin(2 * np.pi * days / 7) + rng.normal(0, 2, 120), 20 + 0.2 * days, rng.poisson(5, 120)])
+ batched = tms_analytics.fit_exponential_smoothing(values, season_length=7)
+ for column in range(values.shape[1]):
+  alone = tms_analytics.fit_exponential_smoothing(values[:, [column]], season_length=7)
+  for name in ('level', 'trend', 'alpha', 'sigma'):
+   assert np.atleast_1d(batched[name])[column] == pytest.approx(np.atleast_1d(alone[name])[0])
+  np.testing.assert_allclose(batched['season'][:, column], alone['season'][:, 0])
+ forecast, lower, upper = tms_analytics.forecast_smoothing(batched, horizon=14)
+ assert forecast.shape == (14, 3) and (lower <= forecast).all() and (forecast <= upper).all()
+ # Bands widen with the horizon (lower bands are clipped at zero), and the seasonal series repeats its weekly shape
+ assert ((upper - forecast)[1:] >= (upper - forecast)[:-1]).all()
+ assert np.corrcoef(forecast[:7, 0], forecast[7:, 0])[0, 1] > 0.9
+
+
+def test_demand_forecast_drops_the_trailing_partial_period():
+ # 2025-01-06 is a Monday; ten full weeks plus three days of an eleventh
+ daily_rollup = pd.DataFrame({'Date': pd.date_range('2025-01-06', periods=73, freq='D'), 'Service': 'CX', 'Country': 'NL',
+                              'Shipments': 4, 'Orders': 0, 'On_Time': 0})
+ matrix = tms_analytics.forecast_matrix(daily_rollup, 'W')
+ assert len(matrix) == 10 and (matrix['CX | NL'] == 28).all()
+ frame, _ = tms_analytics.demand_forecast(daily_rollup, 'W', horizon=4)
+ projected = frame.dropna(subset=['Forecast'])
+ assert projected['Date'].tolist() == list(pd.date_range('2025-03-17', periods=4, freq='W-MON'))
+ assert projected['Forecast'].to_numpy() == pytest.approx(28)
+
+
+class _Figure:
+ def to_json(self):
+  return '{"data": [], "layout": {"title": {"text": "</script><script>alert(1)</script>"}}}'
+
+
+def test_report_html_is_self_contained_and_escaped():
+ sections = [('Top <Lanes>', '- **NL → DE**: 1,234 shipments\n- FR → IT: 5 shipments\n\nA closing <note>.')]
+ report = tms_analytics.build_report_html('Executive <Report>', ['**Period**: 2025'], [('Revenue', '€1,000')], sections,
+                                          [('Volume', _Figure())], plotly_js='window.Plotly = {};')
+ # Plotly is inlined rather than fetched, so the file opens offline
+ assert 'window.Plotly = {};' in report and not re.search(r'<(?:script|link)[^>]+(?:src|href)=', report)
+ # Figure text cannot close the script elements early: only the library and the figure script end
+ assert report.count('</script>') == 2 and '<\\/script><script>alert(1)<\\/script>' in report
+ assert '<title>Executive &lt;Report&gt;</title>' in report
+ assert '<ul><li><strong>NL → DE</strong>: 1,234 shipments</li><li>FR → IT: 5 shipments</li></ul>' in report
+ assert '<h2>Top &lt;Lanes&gt;</h2>' in report and '<p>A closing &lt;note&gt;.</p>' in report
+
+
+def test_unit_reports_partition_the_dataset_by_office(tmp_path):
+ cost_df = _cost_sales(120)
+ raw_df = _shipments(120).assign(TMS_Order=cost_df['Order_Num'].astype(np.int64))
+ otp_df = pd.DataFrame({'TMS_Order': raw_df['TMS_Order'], 'Status': np.where(np.arange(120) % 4, 'ON TIME', 'LATE')})
+ store = str(tmp_path / 'store')
+ assert tms_analytics.save_dataset(store, 'units', {'raw_data': raw_df, 'otp': otp_df, 'cost_sales': cost_df})
+ units = tms_analytics.batch_units(cost_df)
+ assert sorted(units) == ['AMS', 'RTM']
+ reports = [tms_analytics.render_unit_report(store, 'units', 'Office', unit) for unit in units]
+ for (label, kpis, report), unit in zip(reports, units):
+  office = cost_df[cost_df['Office'] == unit]
+  assert label == unit and f'TMS Snapshot - {unit}' in report.decode('utf-8')
+  assert kpis['Orders'] == len(office) and kpis['Shipments'] == len(office)
+  assert kpis['Revenue'] == pytest.approx(office['Net_Revenue'].sum(), abs=0.01)
+  assert kpis['OTP %'] == round((otp_df['Status'][office.index] == 'ON TIME').mean() * 100, 1)
+ assert sum(kpis['Orders'] for _, kpis, _ in reports) == len(cost_df)